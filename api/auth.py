@@ -11,20 +11,31 @@ from tardis.tardis_portal.models.datafile import DataFileObject
 from ..models.uploader import Uploader
 from ..models.uploader import UploaderRegistrationRequest
 from ..models.uploader import UploaderSetting
+from .. import permissions
 
 
 logger = logging.getLogger(__name__)
 
 
+def check_facility_manager(request):
+    """
+    Check if user manages any facility, cached for the request
+    """
+    authuser = request.user
+    if not authuser.is_authenticated:
+        return False
+    return permissions.cached_permission(
+        request,
+        ("facility_manager", authuser.id),
+        lambda: facilities_managed_by(authuser).exists())
+
+
 class ACLAuthorization(tardis.tardis_portal.api.ACLAuthorization):
     """
     Authorisation class for Tastypie
     """
     def read_list(self, object_list, bundle):  # noqa # too complex
-        authuser = bundle.request.user
-        authenticated = authuser.is_authenticated
-        is_facility_manager = authenticated and \
-            len(facilities_managed_by(authuser)) > 0
+        is_facility_manager = check_facility_manager(bundle.request)
         if isinstance(bundle.obj, (User, Uploader, UploaderSetting,
                                    UploaderRegistrationRequest)):
             if is_facility_manager:
@@ -36,10 +47,7 @@ class ACLAuthorization(tardis.tardis_portal.api.ACLAuthorization):
         if bundle.request.user.is_authenticated and \
            bundle.request.user.is_superuser:
             return True
-        authuser = bundle.request.user
-        authenticated = authuser.is_authenticated
-        is_facility_manager = authenticated and \
-            len(facilities_managed_by(authuser)) > 0
+        is_facility_manager = check_facility_manager(bundle.request)
         if isinstance(bundle.obj, (Uploader, UploaderRegistrationRequest)):
             return is_facility_manager
         if isinstance(bundle.obj, DataFileObject):
@@ -47,10 +55,7 @@ class ACLAuthorization(tardis.tardis_portal.api.ACLAuthorization):
         return super().read_detail(object_list, bundle)
 
     def create_detail(self, object_list, bundle):
-        authuser = bundle.request.user
-        authenticated = authuser.is_authenticated
-        is_facility_manager = authenticated and \
-            len(facilities_managed_by(authuser)) > 0
+        is_facility_manager = check_facility_manager(bundle.request)
         if isinstance(bundle.obj, Uploader):
             return is_facility_manager
         if isinstance(bundle.obj, UploaderRegistrationRequest):
@@ -64,10 +69,7 @@ class ACLAuthorization(tardis.tardis_portal.api.ACLAuthorization):
         Uploaders should only be able to update the uploader record whose
         UUID matches theirs (if it exists).
         '''
-        authuser = bundle.request.user
-        authenticated = authuser.is_authenticated
-        is_facility_manager = authenticated and \
-            len(facilities_managed_by(authuser)) > 0
+        is_facility_manager = check_facility_manager(bundle.request)
         if isinstance(bundle.obj, Uploader):
             return is_facility_manager and \
                 bundle.data['uuid'] == bundle.obj.uuid
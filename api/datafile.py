@@ -1,41 +1,186 @@
 import logging
-import traceback
 import os
 import json
 import pytz
+from datetime import datetime, timezone
 
 from django.conf import settings
 from django.conf.urls import url
 from django.core.files.storage import FileSystemStorage, get_storage_class
 from django.db.utils import DatabaseError
 from django.db import IntegrityError
-from django.http import HttpResponse
+from django.db import transaction
+from django.db.models import Count
+from django.db.models.signals import pre_save, post_save
+from django.http import (
+    HttpResponse,
+    HttpResponseForbidden,
+    JsonResponse
+)
 from django.urls import resolve
-from django.utils.timezone import is_aware, make_aware
+from django.utils.timezone import is_aware, make_aware, make_naive
 
 from tastypie import fields
 from tastypie.constants import ALL_WITH_RELATIONS
 from tastypie.exceptions import ImmediateHttpResponse
+from tastypie.http import HttpUnauthorized
 from tastypie.utils import trailing_slash
 from ipware import get_client_ip
 from dateutil.parser import parse
 
 import tardis.tardis_portal.api
+from tardis.tardis_portal.auth.decorators import has_dataset_access
 from tardis.tardis_portal.models.datafile import (
     DataFile,
-    DataFileObject,
-    compute_checksums
+    DataFileObject
 )
+from tardis.tardis_portal.models.dataset import Dataset
+from tardis.tardis_portal.models.storage import StorageBox
+from ..models.upload import UploadSession
 from ..models.uploader import (
     Uploader,
     UploaderRegistrationRequest
 )
 
+from ..localcache import LocalCache
+from ..uploadhandler import ChecksumUploadHandler
+from .. import utils
 from .auth import ACLAuthorization
 
 
 logger = logging.getLogger(__name__)
 
+# Storage boxes approved for uploaders, dropped when uploaders change
+storage_boxes = LocalCache(
+    "mydata_storage_box_generation", "MYDATA_STORAGE_BOX_CACHE_TTL", 300)
+
+
+def normalize_time(value):
+    '''
+    Time comparable with times stored by the database,
+    aware if USE_TZ is set, otherwise naive in TIME_ZONE
+    '''
+    if value is None:
+        return None
+    tz = pytz.timezone(settings.TIME_ZONE)
+    if settings.USE_TZ:
+        if not is_aware(value):
+            value = make_aware(value, tz)
+    elif is_aware(value):
+        value = make_naive(value, tz)
+    return value
+
+
+def parse_mtime(value):
+    '''
+    Modification time from manifest as seconds since epoch
+    or ISO 8601 string
+    '''
+    if value is None or value == '':
+        return None
+    if isinstance(value, (int, float)):
+        return normalize_time(
+            datetime.fromtimestamp(value, tz=timezone.utc))
+    return normalize_time(parse(value))
+
+
+def get_checksum_algorithms():
+    '''
+    Checksums calculated for POSTed files
+    '''
+    algorithms = []
+    if getattr(settings, 'COMPUTE_MD5', True):
+        algorithms.append('md5')
+    if getattr(settings, 'COMPUTE_SHA512', True):
+        algorithms.append('sha512')
+    return algorithms
+
+
+def localize_times(data):
+    '''
+    Make DataFile times in data timezone aware
+    '''
+    if settings.USE_TZ:
+        tz = pytz.timezone(settings.TIME_ZONE)
+        dst = getattr(settings, 'IS_DST', True)
+        for k in ["created_time", "modification_time"]:
+            time_str = data.get(k)
+            if not time_str:
+                continue
+            v = parse(time_str)
+            if not is_aware(v):
+                data[k] = make_aware(v, tz, dst).isoformat()
+
+
+def is_duplicate_error(err):
+    '''
+    Whether IntegrityError is a unique constraint violation
+    '''
+    return "duplicate key" in str(err) or \
+        "UNIQUE constraint failed" in str(err) or \
+        "Duplicate entry" in str(err)
+
+
+def diff_manifest_batch(dataset_id, batch):
+    '''
+    Manifest entries of the batch which have to be uploaded
+    or are still being uploaded
+    '''
+    if not batch:
+        return []
+    datafiles = {}
+    for datafile in DataFile.objects.filter(
+            dataset_id=dataset_id,
+            filename__in={entry[1] for entry in batch}
+    ).order_by('version').values(
+        'id', 'directory', 'filename', 'size', 'md5sum',
+        'modification_time'):
+        # Latest version wins
+        datafiles[(datafile['directory'] or '', datafile['filename'])] = \
+            datafile
+    dfos = {}
+    for dfo in DataFileObject.objects.filter(
+            datafile_id__in=[datafile['id']
+                             for datafile in datafiles.values()]
+    ).values('id', 'datafile_id', 'verified'):
+        # Verified replica wins
+        if not dfos.get(dfo['datafile_id'], {}).get('verified'):
+            dfos[dfo['datafile_id']] = dfo
+    sessions = set(UploadSession.objects.filter(
+        dfo_id__in=[dfo['id'] for dfo in dfos.values()
+                    if not dfo['verified']],
+        received__gt=0
+    ).values_list('dfo_id', flat=True))
+
+    results = []
+    for directory, filename, size, mtime, md5sum in batch:
+        result = {'directory': directory, 'filename': filename}
+        datafile = datafiles.get((directory, filename))
+        if datafile is None:
+            result['status'] = 'new'
+            results.append(result)
+            continue
+        result['id'] = datafile['id']
+        modified = normalize_time(datafile['modification_time'])
+        if str(size) != str(datafile['size']) or \
+                (md5sum and datafile['md5sum'] and
+                 md5sum.lower() != datafile['md5sum'].lower()) or \
+                (mtime is not None and modified is not None and
+                 abs((mtime - modified).total_seconds()) >= 1):
+            result['status'] = 'changed'
+            results.append(result)
+            continue
+        dfo = dfos.get(datafile['id'])
+        if dfo is not None and dfo['verified']:
+            continue
+        result['status'] = 'unverified'
+        if dfo is not None:
+            result['dfo_id'] = dfo['id']
+            if dfo['id'] in sessions:
+                result['status'] = 'partial'
+        results.append(result)
+    return results
+
 
 class DataFileAppResource(tardis.tardis_portal.api.MyTardisModelResource):
     '''
@@ -57,6 +202,9 @@ class DataFileAppResource(tardis.tardis_portal.api.MyTardisModelResource):
         related_name='datafile', full=True, null=True)
     temp_url = None
 
+    # Number of manifest entries compared at once
+    MANIFEST_BATCH_SIZE = 1000
+
     class Meta(tardis.tardis_portal.api.MyTardisModelResource.Meta):
         object_class = DataFile
         queryset = DataFile.objects.all()
@@ -80,11 +228,17 @@ class DataFileAppResource(tardis.tardis_portal.api.MyTardisModelResource):
             compute_sha512 = getattr(settings, 'COMPUTE_SHA512', True)
             if (compute_md5 and 'md5sum' not in bundle.data) or \
                     (compute_sha512 and 'sha512sum' not in bundle.data):
-                checksums = compute_checksums(newfile, close_file=False)
+                # Calculated while the file was received by post_list
+                checksums = getattr(
+                    bundle.request, '_mydata_checksums', {}
+                ).get('attached_file')
+                if checksums is None:
+                    checksums = utils.calc_file_checksums(
+                        get_checksum_algorithms(), newfile)
                 if compute_md5:
-                    bundle.data['md5sum'] = checksums['md5sum']
+                    bundle.data['md5sum'] = checksums['md5']
                 if compute_sha512:
-                    bundle.data['sha512sum'] = checksums['sha512sum']
+                    bundle.data['sha512sum'] = checksums['sha512']
 
             if 'replicas' in bundle.data:
                 for replica in bundle.data['replicas']:
@@ -102,38 +256,77 @@ class DataFileAppResource(tardis.tardis_portal.api.MyTardisModelResource):
         include any replicas.
         '''
         datafile = bundle.obj
-        try:
-            if 'uploader_uuid' in bundle.data and \
-                    'requester_key_fingerprint' in bundle.data:
-                uploader_uuid = bundle.data['uploader_uuid']
-                fingerprint = bundle.data['requester_key_fingerprint']
-                uploader = Uploader.objects.get(uuid=uploader_uuid)
-                uploader_registration_request = \
-                    UploaderRegistrationRequest.objects.get(
-                        uploader=uploader,
-                        requester_key_fingerprint=fingerprint)
-                sbox = uploader_registration_request.approved_storage_box
-            else:
-                ip, _ = get_client_ip(bundle.request)
-                instrument_id = datafile.dataset.instrument.id
-                uploader = Uploader.objects\
-                    .filter(wan_ip_address=ip,
-                            instruments__id=instrument_id)\
-                    .first()
-                uploader_registration_request = \
-                    UploaderRegistrationRequest.objects\
-                    .get(uploader=uploader)
-                sbox = uploader_registration_request.approved_storage_box
-        except Exception:
-            logger.warning(traceback.format_exc())
-            sbox = datafile.get_receiving_storage_box()
-        if sbox is None:
-            raise NotImplementedError
+        sbox = self._get_storage_box(bundle.request, bundle.data, datafile)
         dfo = DataFileObject(
             datafile=datafile,
             storage_box=sbox)
         dfo.create_set_uri()
         dfo.save()
+        self._create_dirs(dfo)
+        self.temp_url = dfo.get_full_path()
+
+    def _get_storage_box(self, request, data, datafile):
+        '''
+        Storage box approved for the uploader sending the request,
+        otherwise receiving storage box of the DataFile.
+        Approved storage box is cached until uploaders change.
+        '''
+        if 'uploader_uuid' in data and \
+                'requester_key_fingerprint' in data:
+            key = ('uuid', data['uploader_uuid'],
+                   data['requester_key_fingerprint'])
+        else:
+            ip, _ = get_client_ip(request)
+            key = ('ip', ip, datafile.dataset.instrument_id)
+        generation = storage_boxes.get_generation()
+        sbox_id = storage_boxes.get(
+            key, lambda: self._find_approved_storage_box(key), generation)
+        sbox = None
+        if sbox_id:
+            sbox = storage_boxes.get(
+                ('sbox', sbox_id),
+                lambda: StorageBox.objects.filter(pk=sbox_id).first(),
+                generation)
+        if sbox is None:
+            sbox = datafile.get_receiving_storage_box()
+        if sbox is None:
+            raise NotImplementedError
+        return sbox
+
+    def _find_approved_storage_box(self, key):
+        '''
+        Id of the storage box approved for the uploader,
+        False if there is none, which is cached unlike None
+        '''
+        if key[0] == 'uuid':
+            _, uploader_uuid, fingerprint = key
+            registration = UploaderRegistrationRequest.objects.filter(
+                uploader__uuid=uploader_uuid,
+                requester_key_fingerprint=fingerprint
+            ).first()
+        else:
+            _, ip, instrument_id = key
+            uploader = Uploader.objects\
+                .filter(wan_ip_address=ip,
+                        instruments__id=instrument_id)\
+                .order_by('id')\
+                .first()
+            # Uploader might have registered several keys
+            registration = UploaderRegistrationRequest.objects\
+                .filter(uploader=uploader)\
+                .order_by('id')\
+                .first() if uploader is not None else None
+        if registration is None or \
+                registration.approved_storage_box_id is None:
+            logger.warning(
+                'No approved storage box for uploader %s %s' % key[:2])
+            return False
+        return registration.approved_storage_box_id
+
+    def _create_dirs(self, dfo):
+        '''
+        Make folder of the DataFileObject if MYDATA_CREATE_DIRS is set
+        '''
         storage_class = get_storage_class(dfo.storage_box.django_storage_class)
         if getattr(settings, 'MYDATA_CREATE_DIRS', False) and \
                 issubclass(storage_class, FileSystemStorage):
@@ -147,48 +340,51 @@ class DataFileAppResource(tardis.tardis_portal.api.MyTardisModelResource):
                 os.chmod(dfo_dir, 0o770)
             except OSError:
                 logger.exception('Failed to make dirs for %s' % dfo_dir)
-        self.temp_url = dfo.get_full_path()
+
+    def _delete_empty_duplicate(self, bundle):
+        '''
+        Delete DataFile conflicting with the insert of bundle.obj
+        if it has no DataFileObjects (e.g. left by failed upload).
+        The row is locked, so replicas can't be added meanwhile.
+        Returns False if the duplicate has to be kept.
+        '''
+        datafile = bundle.obj
+        with transaction.atomic():
+            duplicate = DataFile.objects.select_for_update().filter(
+                dataset=datafile.dataset,
+                filename=datafile.filename,
+                directory=datafile.directory,
+                version=datafile.version
+            ).first()
+            if duplicate is None or duplicate.file_objects.exists():
+                return False
+            duplicate.delete()
+        return True
 
     def obj_create(self, bundle, **kwargs):
         '''
         Creates a new DataFile object from the provided bundle.data dict.
 
-        If a duplicate key error occurs, responds with HTTP Error 409: CONFLICT
-        '''
-        if settings.USE_TZ:
-            tz = pytz.timezone(settings.TIME_ZONE)
-            dst = getattr(settings, 'IS_DST', True)
-            for k in ["created_time", "modification_time"]:
-                time_str = bundle.data.get(k)
-                if not time_str:
-                    continue
-                v = parse(time_str)
-                if not is_aware(v):
-                    bundle.data[k] = make_aware(v, tz, dst).isoformat()
+        If a DataFile with the same name exists, it is replaced if it has
+        no replicas, otherwise responds with HTTP Error 409: CONFLICT.
+        Duplicates are only looked up once the insert has been authorized.
+        '''
+        localize_times(bundle.data)
         try:
-            retval = super().obj_create(bundle, **kwargs)
+            with transaction.atomic():
+                retval = super().obj_create(bundle, **kwargs)
         except IntegrityError as err:
-            if "duplicate key" not in str(err) and \
-                    "UNIQUE constraint failed" not in str(err) and \
-                    "Duplicate entry" not in str(err):
+            if not is_duplicate_error(err):
                 raise
-            # Before returning a conflict error (409), let's check whether
-            # the conflicting record is empty, in which case it can be deleted:
-            filename = bundle.data.get("filename", "")
-            directory = bundle.data.get("directory", "")
-            version = bundle.data.get("version", 1)
-            _, _, kwargs = resolve(bundle.data.get("dataset"))
-            dataset_id = kwargs["pk"]
-            duplicate = DataFile.objects.filter(
-                dataset__id=dataset_id, filename=filename, directory=directory,
-                version=version).first()
-            # If the duplicate has zero DataFileObjects,
-            # delete it and replace it:
-            total = DataFileObject.objects.filter(datafile=duplicate).count()
-            if duplicate and total == 0:
-                duplicate.delete()
-                retval = super().obj_create(bundle, **kwargs)
-            else:
+            if not self._delete_empty_duplicate(bundle):
+                raise ImmediateHttpResponse(HttpResponse(status=409))
+            try:
+                with transaction.atomic():
+                    retval = super().obj_create(bundle, **kwargs)
+            except IntegrityError as err:
+                if not is_duplicate_error(err):
+                    raise
+                # Created again by concurrent request
                 raise ImmediateHttpResponse(HttpResponse(status=409))
         if 'replicas' not in bundle.data or not bundle.data['replicas']:
             # no replica specified: return upload path and create dfo for
@@ -216,6 +412,19 @@ class DataFileAppResource(tardis.tardis_portal.api.MyTardisModelResource):
         return retval
 
     def post_list(self, request, **kwargs):
+        content_type = request.META.get('CONTENT_TYPE', '')
+        if content_type.startswith('multipart') and \
+                not hasattr(request, '_body') and \
+                not hasattr(request, '_files'):
+            # Parse files from the request stream, checksumming them while
+            # they are received, before tastypie would read the whole body
+            handler = ChecksumUploadHandler(
+                request, get_checksum_algorithms())
+            request.upload_handlers.insert(0, handler)
+            request._mydata_checksums = handler.checksums
+            request._load_post_and_files()
+            # Body can't be read from the stream again, see put_detail
+            request._body = b''
         response = super().post_list(request, **kwargs)
         if self.temp_url is not None:
             response.content = self.temp_url
@@ -224,6 +433,12 @@ class DataFileAppResource(tardis.tardis_portal.api.MyTardisModelResource):
 
     def prepend_urls(self):
         return [
+            url(r"^(?P<resource_name>%s)/bulk%s$" %
+                (self._meta.resource_name, trailing_slash()),
+                self.wrap_view('bulk_create'), name="api_bulk_create"),
+            url(r"^(?P<resource_name>%s)/manifest/(?P<dataset_id>\d+)%s$" %
+                (self._meta.resource_name, trailing_slash()),
+                self.wrap_view('diff_manifest'), name="api_diff_manifest"),
             url(r"^(?P<resource_name>%s)/(?P<pk>\w[\w/-]*)/download%s$" %
                 (self._meta.resource_name, trailing_slash()),
                 self.wrap_view('download_file'), name="api_download_file"),
@@ -232,6 +447,277 @@ class DataFileAppResource(tardis.tardis_portal.api.MyTardisModelResource):
                 self.wrap_view('verify_file'), name="api_verify_file"),
         ]
 
+    def diff_manifest(self, request, **kwargs):
+        '''
+        Compare manifest of local files with the dataset.
+
+        Manifest is sent as newline-delimited JSON objects with directory,
+        filename, size, mtime and optional md5sum, and is read in batches,
+        so any number of files takes a few queries per batch.
+        Responds with newline-delimited JSON of entries which are "new",
+        "changed", "unverified" or "partial" (chunked upload in progress),
+        or with 400 and the line number if an entry is invalid.
+        '''
+        self.method_check(request, allowed=['post'])
+        self.is_authenticated(request)
+        dataset_id = int(kwargs['dataset_id'])
+        if not has_dataset_access(request=request, dataset_id=dataset_id):
+            return HttpResponseForbidden()
+
+        # Whole manifest is checked before responding, so errors are
+        # never reported within a successful response
+        results = []
+        batch = []
+        for number, line in enumerate(request, 1):
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+                batch.append((
+                    entry.get('directory') or '',
+                    entry['filename'],
+                    int(entry['size']),
+                    parse_mtime(entry.get('mtime')),
+                    entry.get('md5sum')))
+            except (ValueError, KeyError, TypeError, OverflowError):
+                return JsonResponse({
+                    'success': False,
+                    'error': 'Invalid manifest entry.',
+                    'line': number}, status=400)
+            if len(batch) == self.MANIFEST_BATCH_SIZE:
+                results.extend(diff_manifest_batch(dataset_id, batch))
+                batch = []
+        results.extend(diff_manifest_batch(dataset_id, batch))
+
+        return HttpResponse(
+            ''.join(json.dumps(result) + '\n' for result in results),
+            content_type='application/x-ndjson')
+
+    def bulk_create(self, request, **kwargs):
+        '''
+        Create DataFiles with DataFileObjects for staging in one request.
+
+        Body is JSON with "dataset" URI, optional uploader details
+        used to choose storage box, and "datafiles" list of DataFile fields.
+        Responds with result per DataFile in the same order, either
+        "id", "dfo_id" and "path" to upload to, or "error" and "status"
+        (409 for existing DataFile).
+        '''
+        self.method_check(request, allowed=['post'])
+        self.is_authenticated(request)
+        try:
+            data = json.loads(request.body)
+            _, _, kwargs = resolve(data['dataset'])
+            dataset_id = int(kwargs['pk'])
+            items = list(data['datafiles'])
+        except Exception:
+            return JsonResponse({
+                'success': False,
+                'error': 'Invalid request.'}, status=400)
+        # Same authorization as obj_create, before the dataset is looked up
+        # so missing datasets can't be told apart from inaccessible ones
+        self._authorize_bulk_create(request, data['dataset'], dataset_id)
+        try:
+            dataset = Dataset.objects.select_related('instrument').get(
+                id=dataset_id)
+        except Dataset.DoesNotExist:
+            return JsonResponse({
+                'success': False,
+                'error': 'Invalid request.'}, status=400)
+
+        results = [None] * len(items)
+        datafiles = []
+        for index, item in enumerate(items):
+            try:
+                datafile = self._make_bulk_datafile(dataset, item)
+            except Exception as e:
+                results[index] = {'error': str(e), 'status': 400}
+                continue
+            datafiles.append((index, datafile))
+
+        datafiles, replaced = self._exclude_bulk_conflicts(
+            dataset, datafiles, results)
+        if datafiles:
+            sbox = self._get_storage_box(request, data, datafiles[0][1])
+            try:
+                with transaction.atomic():
+                    self._delete_empty(replaced.values())
+                    created = self._bulk_save(datafiles, sbox)
+            except IntegrityError:
+                # Conflicting DataFiles created meanwhile,
+                # so save one by one
+                created = []
+                for index, datafile in datafiles:
+                    try:
+                        with transaction.atomic():
+                            self._delete_empty(
+                                [replaced[index]] if index in replaced
+                                else [])
+                            created += self._bulk_save(
+                                [(index, datafile)], sbox)
+                    except IntegrityError:
+                        results[index] = {
+                            'error': 'DataFile already exists.',
+                            'status': 409}
+            dirs = set()
+            for index, dfo in created:
+                path = dfo.get_full_path()
+                if os.path.dirname(path) not in dirs:
+                    dirs.add(os.path.dirname(path))
+                    self._create_dirs(dfo)
+                results[index] = {
+                    'id': dfo.datafile.id,
+                    'dfo_id': dfo.id,
+                    'path': path}
+
+        return JsonResponse({'success': True, 'datafiles': results})
+
+    def _authorize_bulk_create(self, request, dataset_uri, dataset_id):
+        '''
+        Check the user may create DataFiles with DataFileObjects
+        in the dataset, responds with HTTP Error 401 otherwise
+        '''
+        bundle = self.build_bundle(
+            obj=DataFile(dataset_id=dataset_id),
+            data={'dataset': dataset_uri},
+            request=request)
+        try:
+            self.authorized_create_detail(
+                self.get_object_list(request), bundle)
+            authorized = request.user.has_perm(
+                'tardis_portal.add_datafileobject')
+        except ImmediateHttpResponse:
+            raise
+        except Exception:
+            # Dataset which doesn't exist
+            authorized = False
+        if not authorized:
+            raise ImmediateHttpResponse(HttpUnauthorized())
+
+    def _make_bulk_datafile(self, dataset, item):
+        '''
+        Unsaved DataFile from bulk request item, validated as
+        DataFile.save would do
+        '''
+        item = dict(item)
+        localize_times(item)
+        datafile = DataFile(
+            dataset=dataset,
+            filename=item['filename'],
+            directory=item.get('directory') or '',
+            size=int(item['size']),
+            md5sum=item.get('md5sum') or '',
+            sha512sum=item.get('sha512sum') or '',
+            mimetype=item.get('mimetype') or '',
+            version=int(item.get('version', 1)),
+            created_time=parse(item['created_time'])
+            if item.get('created_time') else None,
+            modification_time=parse(item['modification_time'])
+            if item.get('modification_time') else None)
+        if getattr(settings, 'REQUIRE_DATAFILE_CHECKSUMS', True) and \
+                not datafile.md5sum and not datafile.sha512sum:
+            raise ValueError('Checksum is required.')
+        if getattr(settings, 'REQUIRE_DATAFILE_SIZES', True) and \
+                not datafile.size:
+            raise ValueError('File size is required.')
+        return datafile
+
+    def _exclude_bulk_conflicts(self, dataset, datafiles, results):
+        '''
+        Drop DataFiles which exist already or repeat within the request,
+        returns accepted DataFiles and ids of existing empty records
+        they replace by index, as obj_create does
+        '''
+        existing = {}
+        for datafile in DataFile.objects.filter(
+                dataset=dataset,
+                filename__in={datafile.filename for _, datafile in datafiles}
+        ).annotate(replicas=Count('file_objects')).values(
+                'id', 'directory', 'filename', 'version', 'replicas'):
+            existing[(datafile['directory'] or '', datafile['filename'],
+                      datafile['version'])] = datafile
+        replaced = {}
+        accepted = []
+        for index, datafile in datafiles:
+            key = (datafile.directory, datafile.filename, datafile.version)
+            duplicate = existing.get(key)
+            if duplicate is not None and \
+                    (duplicate['replicas'] != 0 or duplicate.get('taken')):
+                results[index] = {
+                    'error': 'DataFile already exists.',
+                    'status': 409}
+                continue
+            if duplicate is None:
+                existing[key] = {'replicas': 0, 'taken': True}
+            else:
+                duplicate['taken'] = True
+                replaced[index] = duplicate['id']
+            accepted.append((index, datafile))
+        return accepted, replaced
+
+    def _delete_empty(self, datafile_ids):
+        '''
+        Delete DataFiles which still have no DataFileObjects,
+        in the transaction inserting their replacements
+        '''
+        datafile_ids = list(datafile_ids)
+        if datafile_ids:
+            DataFile.objects.filter(
+                id__in=datafile_ids,
+                file_objects__isnull=True
+            ).delete()
+
+    def _bulk_save(self, datafiles, sbox):
+        '''
+        Insert DataFiles and their DataFileObjects,
+        returns list of (index, DataFileObject).
+        bulk_create skips save(), so model signals, which search indexing
+        and storage hooks rely on, are sent here.
+        '''
+        for _, datafile in datafiles:
+            pre_save.send(sender=DataFile, instance=datafile, raw=False,
+                          using=DataFile.objects.db, update_fields=None)
+        DataFile.objects.bulk_create(
+            [datafile for _, datafile in datafiles])
+        if any(datafile.pk is None for _, datafile in datafiles):
+            # Database doesn't return ids of inserted rows
+            dataset = datafiles[0][1].dataset
+            ids = {
+                (directory or '', filename, version): pk
+                for pk, directory, filename, version in
+                DataFile.objects.filter(
+                    dataset=dataset,
+                    filename__in={datafile.filename
+                                  for _, datafile in datafiles}
+                ).values_list('id', 'directory', 'filename', 'version')}
+            for _, datafile in datafiles:
+                datafile.pk = ids[(datafile.directory, datafile.filename,
+                                   datafile.version)]
+        for _, datafile in datafiles:
+            post_save.send(sender=DataFile, instance=datafile, created=True,
+                           raw=False, using=DataFile.objects.db,
+                           update_fields=None)
+        dfos = []
+        for index, datafile in datafiles:
+            dfo = DataFileObject(datafile=datafile, storage_box=sbox)
+            dfo.create_set_uri()
+            pre_save.send(sender=DataFileObject, instance=dfo, raw=False,
+                          using=DataFileObject.objects.db,
+                          update_fields=None)
+            dfos.append((index, dfo))
+        DataFileObject.objects.bulk_create([dfo for _, dfo in dfos])
+        if any(dfo.pk is None for _, dfo in dfos):
+            ids = dict(DataFileObject.objects.filter(
+                datafile__in=[datafile for _, datafile in datafiles]
+            ).values_list('datafile_id', 'id'))
+            for _, dfo in dfos:
+                dfo.pk = ids[dfo.datafile.pk]
+        for _, dfo in dfos:
+            post_save.send(sender=DataFileObject, instance=dfo, created=True,
+                           raw=False, using=DataFileObject.objects.db,
+                           update_fields=None)
+        return dfos
+
     def deserialize(self, request, data, format=None):
         '''
         from https://github.com/toastdriven/django-tastypie/issues/42
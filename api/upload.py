@@ -1,27 +1,45 @@
 import logging
+import json
 import os
 import re
 import math
 
 from django.conf import settings
 from django.conf.urls import url
+from django.core import signing
+from django.core.cache import cache
+from django.core.files.storage import FileSystemStorage, get_storage_class
+from django.db import IntegrityError, transaction
 from django.http import JsonResponse
 from tastypie.utils import trailing_slash
 
 import tardis.tardis_portal.api
 
+from tardis.tardis_portal.models.dataset import Dataset
 from tardis.tardis_portal.models.datafile import DataFileObject
+from tardis.tardis_portal.models.experiment import Experiment
 
 from .auth import ACLAuthorization
 
-from ..models.chunk import Chunk
+from ..models.chunk import Chunk, ChunkContent
+from ..models.upload import UploadSession
 
 from .. import utils
+from .. import staging
+from .. import chunkstore
+from .. import throttling
+from .. import permissions
 from .. import tasks
 
 
 logger = logging.getLogger(__name__)
 
+# Namespace of upload token signatures
+UPLOAD_TOKEN_SALT = "mydata.upload"
+
+# Set while a chunk is written into the data file at the offset
+PLACEMENT_KEY = "mydata_chunk_placement_%s_%s"
+
 
 class UploadAppResource(tardis.tardis_portal.api.MyTardisModelResource):
     """
@@ -29,6 +47,9 @@ class UploadAppResource(tardis.tardis_portal.api.MyTardisModelResource):
     https://docs.google.com/document/d/1wZDwReW8LyplHJiUuH3QTzNguODX6mU2-8J6XN7PzZk/edit
     """
 
+    # Number of objects to query at once for upload status
+    STATUS_BATCH_SIZE = 500
+
     class Meta(tardis.tardis_portal.api.MyTardisModelResource.Meta):
         resource_name = "upload"
         allowed_methods = ["get", "put", "post"]
@@ -41,6 +62,14 @@ class UploadAppResource(tardis.tardis_portal.api.MyTardisModelResource):
 
     def prepend_urls(self):
         return [
+            url(
+                r"^(?P<resource_name>%s)/status%s$" % (
+                    self._meta.resource_name,
+                    trailing_slash()
+                ),
+                self.wrap_view("get_uploads"),
+                name="api_mydata_get_uploads"
+            ),
             url(
                 r"^(?P<resource_name>%s)/(?P<dfo_id>\d+)%s$" % (
                     self._meta.resource_name,
@@ -57,6 +86,14 @@ class UploadAppResource(tardis.tardis_portal.api.MyTardisModelResource):
                 self.wrap_view("upload_chunk"),
                 name="api_mydata_upload_chunk"
             ),
+            url(
+                r"^(?P<resource_name>%s)/(?P<dfo_id>\d+)/link%s$" % (
+                    self._meta.resource_name,
+                    trailing_slash()
+                ),
+                self.wrap_view("link_chunk"),
+                name="api_mydata_link_chunk"
+            ),
             url(
                 r"^(?P<resource_name>%s)/(?P<dfo_id>\d+)/complete%s$" % (
                     self._meta.resource_name,
@@ -67,29 +104,170 @@ class UploadAppResource(tardis.tardis_portal.api.MyTardisModelResource):
             ),
         ]
 
+    def get_writable_experiments(self, request, experiment_ids):
+        """
+        Filter IDs of experiments the user can add data to
+        """
+        if len(experiment_ids) == 0:
+            return set()
+        return {
+            experiment.id
+            for experiment in Experiment.objects.filter(id__in=experiment_ids)
+            if request.user.has_perm(
+                "tardis_acls.change_experiment",
+                experiment)
+        }
+
+    def get_dfo(self, request, dfo_id):
+        """
+        Load DataFileObject with everything upload endpoints use,
+        once per request
+        """
+        loaded = getattr(request, "_mydata_dfos", None)
+        if loaded is None:
+            loaded = {}
+            request._mydata_dfos = loaded
+        dfo_id = int(dfo_id)
+        if dfo_id not in loaded:
+            loaded[dfo_id] = DataFileObject.objects.select_related(
+                "datafile__dataset__instrument",
+                "storage_box"
+            ).get(id=dfo_id)
+        return loaded[dfo_id]
+
     def check_dfo(self, request, dfo_id):
-        try:
-            dfo = DataFileObject.objects.get(id=dfo_id)
-            return any(
-                request.user.has_perm(
-                    "tardis_acls.change_experiment",
-                    experiment
-                ) for experiment in dfo.datafile.dataset.experiments.all())
-        except Exception:
-            pass
+        def has_access():
+            try:
+                dfo = self.get_dfo(request, dfo_id)
+                return any(
+                    request.user.has_perm(
+                        "tardis_acls.change_experiment",
+                        experiment
+                    ) for experiment in dfo.datafile.dataset.experiments.all())
+            except Exception:
+                pass
+
+            return None
 
-        return None
+        return permissions.cached_permission(
+            request,
+            ("change_dfo", request.user.id, str(dfo_id)),
+            has_access)
 
-    def handle_error(self, message):
+    def handle_error(self, message, retry_after=None, status=503):
         """
-        Return error message in JSON format
+        Return error message in JSON format,
+        temporary errors tell client when to retry
         """
         data = {
             "success": False,
             "error": message
         }
 
-        return JsonResponse(data, status=200)
+        if retry_after is None:
+            return JsonResponse(data, status=200)
+
+        data["retry_after"] = retry_after
+        response = JsonResponse(data, status=status)
+        response["Retry-After"] = str(retry_after)
+        return response
+
+    def remove_chunk_file(self, file_path):
+        """
+        Remove partially received or rejected chunk file
+        """
+        try:
+            os.remove(file_path)
+        except Exception:
+            pass
+
+    def use_direct_placement(self, dfo):
+        """
+        Check if chunks can be written straight into data file,
+        which is only possible for filesystem-based storage boxes
+        """
+        if not getattr(settings, "CHUNK_DIRECT_PLACEMENT", False):
+            return False
+        storage_class = get_storage_class(dfo.storage_box.django_storage_class)
+        return issubclass(storage_class, FileSystemStorage)
+
+    def open_data_file(self, dfo):
+        """
+        Open preallocated data file for chunks written at their offsets
+        """
+        dst_path = dfo.get_full_path()
+        os.makedirs(os.path.dirname(dst_path), mode=0o770, exist_ok=True)
+        return utils.preallocate_file(
+            dst_path,
+            dfo.datafile.size,
+            getattr(settings, "CHUNK_PREALLOCATE", "sparse"))
+
+    def lock_range(self, dfo_id, offset):
+        """
+        Take chunk range of the data file for writing, so concurrent
+        uploads of the same chunk can't overwrite a verified one.
+        Returns False if the range is being written already.
+        """
+        return cache.add(
+            PLACEMENT_KEY % (dfo_id, offset), True,
+            getattr(settings, "CHUNK_THROTTLE_TIMEOUT", 3600))
+
+    def unlock_range(self, dfo_id, offset):
+        cache.delete(PLACEMENT_KEY % (dfo_id, offset))
+
+    def place_chunk(self, dfo, file_path, offset, length):
+        """
+        Copy chunk file into preallocated data file at the offset
+        """
+        fd = self.open_data_file(dfo)
+        try:
+            with open(file_path, "rb") as src:
+                copied = utils.copy_file_at(
+                    src.fileno(), fd, offset, length,
+                    settings.CHUNK_COPY_SIZE)
+        finally:
+            os.close(fd)
+        if copied != length:
+            raise IOError("Incomplete chunk file %s" % file_path)
+
+    def parse_content_range(self, value):
+        """
+        Start and end of chunk in 'Content-Range' header,
+        None if the header is malformed
+        """
+        m = re.search(r"^(\d+)\-(\d+)\/(\d+)$", value)
+        if m is None:
+            return None
+        return int(m.group(1)), int(m.group(2))
+
+    def get_header(self, request, name):
+        """
+        Get request header, which might be passed in META as is
+        """
+        value = request.headers.get(name, None)
+        if value is None:
+            value = request.META.get(name, None)
+        return value
+
+    def get_dedup_algorithm(self):
+        """
+        Checksum algorithm identifying stored chunk content,
+        None if chunk deduplication is disabled
+        """
+        if not getattr(settings, "CHUNK_DEDUP", False):
+            return None
+        return getattr(settings, "CHUNK_DEDUP_CHECKSUM", "sha256")
+
+    def get_checksum_algorithms(self):
+        """
+        Checksum algorithms accepted for chunks
+        """
+        algorithms = [settings.CHUNK_CHECKSUM]
+        for algorithm in getattr(settings, "CHUNK_CHECKSUMS", []):
+            if algorithm not in algorithms:
+                algorithms.append(algorithm)
+        return [algorithm for algorithm in algorithms
+                if algorithm in utils.CHECKSUM_ALGORITHMS]
 
     def get_chunk_size(self, file_size):
         """
@@ -104,6 +282,19 @@ class UploadAppResource(tardis.tardis_portal.api.MyTardisModelResource):
             if chunk_size > settings.CHUNK_MAX_SIZE:
                 return settings.CHUNK_MAX_SIZE
 
+    def start_session(self, dfo, file_size):
+        """
+        Get upload session of DataFileObject or start a new one,
+        starting over if the assembled file failed verification
+        """
+        chunk_size = self.get_chunk_size(file_size)
+        session = UploadSession.get_or_start(dfo.id, file_size, chunk_size)
+        if session.is_lost(tasks.get_assembly_timeout()):
+            tasks.restart_upload(dfo.id)
+            session = UploadSession.get_or_start(
+                dfo.id, file_size, chunk_size)
+        return session
+
     def get_chunks(self, request, **kwargs):
         """
         Get status of data file upload
@@ -114,30 +305,158 @@ class UploadAppResource(tardis.tardis_portal.api.MyTardisModelResource):
         if not self.check_dfo(request, kwargs["dfo_id"]):
             return self.handle_error("Invalid object or access denied.")
 
-        dfo = DataFileObject.objects.get(id=kwargs["dfo_id"])
+        dfo = self.get_dfo(request, kwargs["dfo_id"])
         file_size = dfo.datafile.size
 
+        session = None
+        if not dfo.verified:
+            # Check for uploaded chunks
+            session = UploadSession.get_or_describe(
+                dfo.id, file_size, self.get_chunk_size(file_size))
+
+        data = self.get_upload_status(dfo.verified, file_size, session)
+        if not data["completed"]:
+            data["token"] = self.make_upload_token(dfo.id, request.user.id)
+
+        return JsonResponse(data, status=200)
+
+    def make_upload_token(self, dfo_id, user_id):
+        """
+        Signed token letting the user upload chunks of the data file,
+        valid for CHUNK_TOKEN_MAX_AGE seconds
+        """
+        return signing.dumps({
+            "dfo": dfo_id,
+            "user": user_id
+        }, salt=UPLOAD_TOKEN_SALT, compress=True)
+
+    def check_upload_token(self, token, dfo_id):
+        """
+        Token contents if it is valid for the data file, otherwise None
+        """
+        try:
+            grant = signing.loads(
+                token,
+                salt=UPLOAD_TOKEN_SALT,
+                max_age=getattr(settings, "CHUNK_TOKEN_MAX_AGE", 3600))
+        except signing.BadSignature:
+            return None
+        if grant.get("dfo") != int(dfo_id):
+            return None
+        return grant
+
+    def get_upload_status(self, verified, file_size, session):
+        """
+        Status of data file upload for the client
+        """
         data = {
             "success": True,
             "completed": True
         }
 
-        if not dfo.verified:
-
-            try:
-                # Check for uploaded chunks
-                last_chunk = Chunk.objects.filter(
-                    dfo_id=kwargs["dfo_id"]
-                ).order_by("-offset")[0]
-                offset = min(last_chunk.offset + last_chunk.size, file_size)
-            except Exception:
-                offset = 0
-
-            if offset != file_size:
+        if not verified:
+            if session is not None and \
+                    session.is_lost(tasks.get_assembly_timeout()):
+                # Assembled file failed verification, upload starts over
+                session = None
+            if session is not None:
+                missing = session.missing_ranges()
+                chunk_size = session.chunk_size
+            else:
+                missing = [[0, file_size]] if file_size != 0 else []
+                chunk_size = self.get_chunk_size(file_size)
+
+            if len(missing) == 0 and session is not None and \
+                    not session.is_accepting():
+                # File is being assembled or verified
+                data["completed"] = False
+                data["offset"] = file_size
+                data["missing"] = []
+                data["state"] = session.state
+            elif len(missing) != 0:
                 data["completed"] = False
-                data["offset"] = offset
-                data["size"] = self.get_chunk_size(file_size)
+                data["offset"] = missing[0][0]
+                data["missing"] = missing
+                data["size"] = chunk_size
                 data["checksum"] = settings.CHUNK_CHECKSUM
+                data["checksums"] = self.get_checksum_algorithms()
+                data["encodings"] = list(utils.CONTENT_ENCODINGS)
+                dedup_algorithm = self.get_dedup_algorithm()
+                if dedup_algorithm is not None:
+                    data["dedup"] = dedup_algorithm
+
+        return data
+
+    def get_uploads(self, request, **kwargs):
+        """
+        Get status of many data file uploads, dfo_ids are passed
+        as JSON list in request body
+        """
+        self.method_check(request, allowed=["post"])
+        self.is_authenticated(request)
+
+        try:
+            dfo_ids = [int(dfo_id) for dfo_id in
+                       json.loads(request.body.decode())["dfo_ids"]]
+        except Exception:
+            return self.handle_error("Invalid list of objects.")
+
+        uploads = {}
+        for dfo_id in dfo_ids:
+            uploads[str(dfo_id)] = {
+                "success": False,
+                "error": "Invalid object or access denied."
+            }
+
+        for pos in range(0, len(dfo_ids), self.STATUS_BATCH_SIZE):
+            batch = dfo_ids[pos:pos+self.STATUS_BATCH_SIZE]
+            dfos = list(DataFileObject.objects.filter(
+                id__in=batch
+            ).values(
+                "id", "verified", "datafile__size", "datafile__dataset_id"))
+
+            # Check permissions once for every experiment in the batch
+            experiments = {}
+            for dataset_id, experiment_id in Dataset.experiments.through\
+                    .objects.filter(
+                        dataset_id__in={
+                            dfo["datafile__dataset_id"] for dfo in dfos}
+                    ).values_list("dataset_id", "experiment_id"):
+                experiments.setdefault(dataset_id, set()).add(experiment_id)
+            allowed = self.get_writable_experiments(
+                request,
+                set().union(*experiments.values()))
+            dfos = [dfo for dfo in dfos if not experiments.get(
+                dfo["datafile__dataset_id"], set()).isdisjoint(allowed)]
+
+            sessions = {
+                session.dfo_id: session
+                for session in UploadSession.objects.filter(
+                    dfo_id__in=[dfo["id"] for dfo in dfos])
+            }
+            # Uploads started before sessions existed
+            legacy = set(Chunk.objects.filter(
+                dfo_id__in=[dfo["id"] for dfo in dfos
+                            if not dfo["verified"] and
+                            dfo["id"] not in sessions]
+            ).values_list("dfo_id", flat=True).distinct())
+            for dfo in dfos:
+                if dfo["id"] in legacy:
+                    sessions[dfo["id"]] = UploadSession.from_chunks(
+                        dfo["id"],
+                        dfo["datafile__size"],
+                        self.get_chunk_size(dfo["datafile__size"]))
+
+            for dfo in dfos:
+                uploads[str(dfo["id"])] = self.get_upload_status(
+                    dfo["verified"],
+                    dfo["datafile__size"],
+                    sessions.get(dfo["id"]))
+
+        data = {
+            "success": True,
+            "uploads": uploads
+        }
 
         return JsonResponse(data, status=200)
 
@@ -145,98 +464,324 @@ class UploadAppResource(tardis.tardis_portal.api.MyTardisModelResource):
         """
         Upload chunk of data file
         """
-        import uuid
-
         self.method_check(request, allowed=["post"])
-        self.is_authenticated(request)
 
-        if not self.check_dfo(request, kwargs["dfo_id"]):
-            return self.handle_error("Invalid object or access denied.")
+        # Token issued by get_chunks replaces authorization queries
+        token = self.get_header(request, "Upload-Token")
+        if token is not None:
+            grant = self.check_upload_token(token, kwargs["dfo_id"])
+            if grant is None:
+                return self.handle_error("Invalid or expired upload token.")
+            user_id = grant["user"]
+        else:
+            self.is_authenticated(request)
+            if not self.check_dfo(request, kwargs["dfo_id"]):
+                return self.handle_error("Invalid object or access denied.")
+            user_id = request.user.id
 
-        checksum = request.headers.get("Checksum", None)
+        checksum = self.get_header(request, "Checksum")
         if checksum is None:
-            checksum = request.META.get("Checksum", None)
-            if checksum is None:
-                return self.handle_error("Missing 'Checksum' in header.")
+            return self.handle_error("Missing 'Checksum' in header.")
 
-        content_range = request.headers.get("Content-Range", None)
+        content_range = self.get_header(request, "Content-Range")
         if content_range is None:
-            content_range = request.META.get("Content-Range", None)
-            if content_range is None:
-                return self.handle_error("Missing 'Content-Range' in header.")
+            return self.handle_error("Missing 'Content-Range' in header.")
 
-        m = re.search(r"^(\d+)\-(\d+)\/(\d+)$", content_range).groups()
-        content_start = int(m[0])
-        content_end = int(m[1])
+        parsed = self.parse_content_range(content_range)
+        if parsed is None:
+            return self.handle_error("Invalid 'Content-Range' in header.")
+        content_start, content_end = parsed
         content_length = content_end-content_start
         if content_length > settings.CHUNK_MAX_SIZE:
             return self.handle_error("Chunk size is larger than max allowed.")
 
-        check = Chunk.objects.filter(
-            dfo_id=kwargs["dfo_id"],
-            offset=content_start
-        )
-        if len(check) != 0:
+        algorithm = self.get_header(request, "Checksum-Algorithm")
+        if algorithm is None:
+            algorithm = settings.CHUNK_CHECKSUM
+        if algorithm not in self.get_checksum_algorithms():
+            return self.handle_error(
+                "Unsupported checksum algorithm {}.".format(algorithm))
+        # Compressed body is inflated while written, so checksum and size
+        # are of the chunk data
+        encoding = self.get_header(request, "Content-Encoding")
+        if encoding in [None, "identity"]:
+            stream = request
+        elif encoding in utils.CONTENT_ENCODINGS:
+            stream = utils.DecompressingReader(
+                request,
+                encoding,
+                getattr(settings, "CHUNK_STREAM_SIZE", 1000000))
+        else:
+            return self.handle_error(
+                "Unsupported content encoding {}.".format(encoding))
+
+        dedup_algorithm = self.get_dedup_algorithm()
+        hasher = utils.MultiHasher(
+            [algorithm] + ([dedup_algorithm] if dedup_algorithm else []))
+
+        try:
+            dfo = self.get_dfo(request, kwargs["dfo_id"])
+        except DataFileObject.DoesNotExist:
+            # Removed since the token was issued
+            return self.handle_error("Invalid object or access denied.")
+        file_size = dfo.datafile.size
+        if content_end > file_size:
+            return self.handle_error("Chunk is out of file range.")
+
+        # Chunks might arrive in any order, but must follow
+        # chunk boundaries of the upload
+        session = self.start_session(dfo, file_size)
+        if not session.is_aligned(content_start, content_length):
+            return self.handle_error(
+                "Chunk is not aligned to upload chunk size.")
+        if session.has_chunk(content_start):
             return self.handle_error("Chunk already uploaded.")
 
-        content_checksum = utils.calc_checksum(
-            settings.CHUNK_CHECKSUM,
-            request.body
-        )
-        if content_checksum is None or content_checksum != checksum:
+        # Share upload capacity fairly between instruments and users
+        throttle = throttling.UploadThrottle(
+            dfo.datafile.dataset.instrument_id, user_id)
+        retry_after = throttle.acquire(content_length)
+        if retry_after is not None:
             return self.handle_error(
-                "Checksum does not match. {}:{}".format(
-                    settings.CHUNK_CHECKSUM,
-                    content_checksum
-                ))
+                "Upload limit reached.", retry_after, status=429)
+        try:
+            return self.receive_chunk(
+                user_id, stream, dfo, session, content_start, content_length,
+                checksum, algorithm, hasher, dedup_algorithm)
+        finally:
+            throttle.release()
+
+    def receive_chunk(self, user_id, stream, dfo, session, content_start,
+                      content_length, checksum, algorithm, hasher,
+                      dedup_algorithm):
+        """
+        Store chunk body and record the chunk
+        """
+        # Chunks are not staged locally for object storage
+        object_store = chunkstore.get_object_store(dfo)
+        direct = object_store is None and self.use_direct_placement(dfo)
+        if not direct:
+            return self.store_chunk(
+                user_id, stream, dfo, session, object_store, content_start,
+                content_length, checksum, algorithm, hasher, dedup_algorithm)
+
+        if not self.lock_range(dfo.id, content_start):
+            return self.handle_error(
+                "Chunk upload in progress.",
+                getattr(settings, "CHUNK_RETRY_AFTER", 60))
+        try:
+            return self.store_chunk(
+                user_id, stream, dfo, session, None, content_start,
+                content_length, checksum, algorithm, hasher, dedup_algorithm,
+                direct=True)
+        finally:
+            self.unlock_range(dfo.id, content_start)
+
+    def store_chunk(self, user_id, stream, dfo, session, object_store,
+                    content_start, content_length, checksum, algorithm,
+                    hasher, dedup_algorithm, direct=False):
+        """
+        Write chunk body to object storage, staging root or straight into
+        data file, and record the chunk once its checksum matches.
+        Range of the data file isn't trusted until the chunk is recorded,
+        so a rejected chunk written into it is left to be overwritten
+        by the retry.
+        """
+        import uuid
+
+        chunk_id = str(uuid.uuid4())
+        placed = object_store is not None or direct
+        root = ""
+        etag = ""
+        file_path = None
 
-        if not os.path.exists(settings.CHUNK_STORAGE):
+        if object_store is not None:
             try:
-                os.mkdir(settings.CHUNK_STORAGE)
+                content_received, etag = object_store.put_part(
+                    object_store.get_upload_id(session),
+                    session.chunk_index(content_start) + 1,
+                    stream,
+                    content_length,
+                    hasher,
+                    checksum,
+                    algorithm)
             except Exception as e:
                 return self.handle_error(str(e))
-
-        data_path = os.path.join(settings.CHUNK_STORAGE, kwargs["dfo_id"])
-        if not os.path.exists(data_path):
+        elif direct:
+            try:
+                fd = self.open_data_file(dfo)
+                try:
+                    content_received = utils.copy_stream(
+                        stream,
+                        utils.OffsetWriter(fd, content_start).write,
+                        content_length,
+                        hasher,
+                        getattr(settings, "CHUNK_STREAM_SIZE", 1000000))
+                finally:
+                    os.close(fd)
+            except Exception as e:
+                return self.handle_error(str(e))
+        else:
+            try:
+                root = session.root or staging.choose_staging_root(dfo)
+                reserved = staging.reserve_space(session, root)
+            except Exception as e:
+                return self.handle_error(str(e))
+            if not reserved:
+                return self.handle_error(
+                    "Not enough space to stage the upload.",
+                    getattr(settings, "CHUNK_RETRY_AFTER", 60))
+            root = session.root or root
+
+            if not os.path.exists(root):
+                try:
+                    os.mkdir(root)
+                except Exception as e:
+                    return self.handle_error(str(e))
+
+            data_path = os.path.join(root, str(dfo.id))
+            if not os.path.exists(data_path):
+                try:
+                    os.makedirs(data_path, mode=0o770, exist_ok=True)
+                    os.chmod(data_path, 0o770)
+                except Exception as e:
+                    return self.handle_error(str(e))
+
+            file_path = os.path.join(data_path, chunk_id)
+
+            # Stream request body to disk, so memory use doesn't depend
+            # on the chunk size
             try:
-                os.makedirs(data_path, mode=0o770, exist_ok=True)
-                os.chmod(data_path, 0o770)
+                with open(file_path, "wb") as file:
+                    content_received = utils.copy_stream(
+                        stream,
+                        file.write,
+                        content_length,
+                        hasher,
+                        getattr(settings, "CHUNK_STREAM_SIZE", 1000000))
             except Exception as e:
+                self.remove_chunk_file(file_path)
                 return self.handle_error(str(e))
 
-        chunk_id = str(uuid.uuid4())
-        file_path = os.path.join(data_path, chunk_id)
+        if content_received != content_length:
+            if file_path is not None:
+                self.remove_chunk_file(file_path)
+            return self.handle_error(
+                "Chunk size does not match 'Content-Range'.")
+
+        checksums = hasher.hexdigests()
+        content_checksum = checksums[algorithm]
+        if content_checksum != checksum:
+            if file_path is not None:
+                self.remove_chunk_file(file_path)
+            return self.handle_error(
+                "Checksum does not match. {}:{}".format(
+                    algorithm,
+                    content_checksum
+                ))
+
+        digest = None
+        if dedup_algorithm and not placed:
+            # Keep chunk in content store, shared between uploads
+            digest = checksums[dedup_algorithm]
 
         try:
-            with open(file_path, "wb") as file:
-                file.write(request.body)
-                file.close()
+            chunk = self.save_chunk(
+                user_id, dfo, session, chunk_id, content_start,
+                content_length, placed, root, etag,
+                file_path if digest else None, digest)
+        except IntegrityError:
+            if file_path is not None:
+                self.remove_chunk_file(file_path)
+            return self.handle_error("Chunk already uploaded.")
         except Exception as e:
+            if file_path is not None:
+                self.remove_chunk_file(file_path)
             return self.handle_error(str(e))
 
-        dfo = DataFileObject.objects.get(id=kwargs["dfo_id"])
+        data = {
+            "success": True,
+            "id": chunk.id
+        }
+
+        return JsonResponse(data, status=200)
 
-        instrument = dfo.datafile.dataset.instrument
-        if instrument is not None:
-            instrument_id = instrument.id
-        else:
-            instrument_id = None
+    def link_chunk(self, request, **kwargs):
+        """
+        Add chunk to data file upload from content stored on the server,
+        so the same chunk doesn't have to be transferred again
+        """
+        import uuid
+
+        self.method_check(request, allowed=["post"])
+        self.is_authenticated(request)
+
+        dedup_algorithm = self.get_dedup_algorithm()
+        if dedup_algorithm is None:
+            return self.handle_error("Chunk deduplication is disabled.")
 
+        if not self.check_dfo(request, kwargs["dfo_id"]):
+            return self.handle_error("Invalid object or access denied.")
+
+        checksum = self.get_header(request, "Checksum")
+        if checksum is None:
+            return self.handle_error("Missing 'Checksum' in header.")
+
+        content_range = self.get_header(request, "Content-Range")
+        if content_range is None:
+            return self.handle_error("Missing 'Content-Range' in header.")
+
+        parsed = self.parse_content_range(content_range)
+        if parsed is None:
+            return self.handle_error("Invalid 'Content-Range' in header.")
+        content_start, content_end = parsed
+        content_length = content_end-content_start
+
+        dfo = self.get_dfo(request, kwargs["dfo_id"])
+        file_size = dfo.datafile.size
+        if content_end > file_size:
+            return self.handle_error("Chunk is out of file range.")
+
+        session = self.start_session(dfo, file_size)
+        if not session.is_aligned(content_start, content_length):
+            return self.handle_error(
+                "Chunk is not aligned to upload chunk size.")
+        if session.has_chunk(content_start):
+            return self.handle_error("Chunk already uploaded.")
+
+        content = ChunkContent.objects.filter(
+            digest=checksum.lower(),
+            size=content_length
+        ).first()
+        if content is None or not os.path.exists(content.get_path()):
+            return self.handle_error("Chunk content not found.")
+
+        if chunkstore.get_object_store(dfo) is not None:
+            return self.handle_error(
+                "Chunk deduplication is not available for the storage.")
+
+        placed = self.use_direct_placement(dfo)
+        if placed and not self.lock_range(dfo.id, content_start):
+            return self.handle_error(
+                "Chunk upload in progress.",
+                getattr(settings, "CHUNK_RETRY_AFTER", 60))
         try:
-            chunk = Chunk.objects.create(
-                chunk_id=chunk_id,
-                dfo_id=kwargs["dfo_id"],
-                offset=content_start,
-                size=content_length,
-                instrument_id=instrument_id,
-                user_id=request.user.id
-            )
+            if placed:
+                # Stored content is copied into data file before the chunk
+                # is recorded, so no transaction is held while copying
+                self.place_chunk(
+                    dfo, content.get_path(), content_start, content_length)
+            chunk = self.save_chunk(
+                request.user.id, dfo, session, str(uuid.uuid4()),
+                content_start, content_length, placed,
+                digest=None if placed else content.digest)
+        except IntegrityError:
+            return self.handle_error("Chunk already uploaded.")
         except Exception as e:
-            try:
-                os.remove(file_path)
-            except Exception:
-                pass
             return self.handle_error(str(e))
+        finally:
+            if placed:
+                self.unlock_range(dfo.id, content_start)
 
         data = {
             "success": True,
@@ -245,6 +790,43 @@ class UploadAppResource(tardis.tardis_portal.api.MyTardisModelResource):
 
         return JsonResponse(data, status=200)
 
+    def save_chunk(self, user_id, dfo, session, chunk_id, offset, length,
+                   placed, root="", etag="", source=None, digest=None):
+        """
+        Record received chunk.
+        Chunk with digest refers to content store, which takes the verified
+        source file unless the content is stored already. The file is only
+        moved once everything else is recorded, so a failed insert leaves
+        it staged to be removed by the caller.
+        """
+        instrument_id = dfo.datafile.dataset.instrument_id
+
+        with transaction.atomic():
+            content = None
+            if digest is not None:
+                # Content stays locked until the chunk is recorded
+                content = ChunkContent.lock(
+                    digest, length, create=source is not None)
+            chunk = Chunk.objects.create(
+                chunk_id=chunk_id,
+                dfo_id=dfo.id,
+                offset=offset,
+                size=length,
+                instrument_id=instrument_id,
+                user_id=user_id,
+                placed=placed,
+                content=content,
+                root=root,
+                etag=etag
+            )
+            if content is not None:
+                content.add_ref()
+            session.add_chunk(offset, length)
+            if content is not None and source is not None:
+                content.store(source)
+
+        return chunk
+
     def complete_upload(self, request, **kwargs):
         """
         Complete upload and create full file
@@ -256,15 +838,19 @@ class UploadAppResource(tardis.tardis_portal.api.MyTardisModelResource):
         if not self.check_dfo(request, kwargs["dfo_id"]):
             return self.handle_error("Invalid object or access denied.")
 
-        dfo = DataFileObject.objects.get(id=kwargs["dfo_id"])
+        dfo = self.get_dfo(request, kwargs["dfo_id"])
 
         if not dfo.verified:
             # Async task as we can't wait until file is ready
-            tasks.complete_chunked_upload.apply_async(args=[dfo.id])
+            tasks.schedule_complete_upload(dfo.id)
 
         data = {
             "success": True,
             "verified": dfo.verified
         }
 
+        session = UploadSession.objects.filter(dfo_id=dfo.id).first()
+        if session is not None:
+            data["state"] = session.state
+
         return JsonResponse(data, status=200)
@@ -4,3 +4,7 @@ from tardis.app_config import AbstractTardisAppConfig
 class MyDataConfig(AbstractTardisAppConfig):
     name = "tardis.apps.mydata"
     verbose_name = "MyData"
+
+    def ready(self):
+        super().ready()
+        from . import signals  # noqa
@@ -0,0 +1,170 @@
+import posixpath
+import tempfile
+import logging
+
+from django.conf import settings
+
+from tardis.tardis_portal.models.storage import StorageBox
+
+from .models.upload import UploadSession
+from . import utils
+
+
+logger = logging.getLogger(__name__)
+
+# S3 rejects parts below this size, except the last one
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+
+def get_error_code(error):
+    """
+    Error code of S3 client error, None for other errors
+    """
+    response = getattr(error, "response", None)
+    if not isinstance(response, dict):
+        return None
+    return response.get("Error", {}).get("Code")
+
+
+class ObjectChunkStore:
+    """
+    Stage chunks as parts of a multipart upload to the object storage
+    of a storage box, composed into the data file on the server side,
+    so the file is never assembled locally
+    """
+
+    def __init__(self, client, bucket, key, storage_box_id=None):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.storage_box_id = storage_box_id
+
+    def get_upload_id(self, session):
+        """
+        Multipart upload of the session, started on the first chunk
+        """
+        if session.multipart_id:
+            return session.multipart_id
+        if session.chunks_count > 1 and session.chunk_size < MIN_PART_SIZE:
+            raise ValueError(
+                "Chunk size %s is below minimum part size %s of "
+                "object storage." % (session.chunk_size, MIN_PART_SIZE))
+        upload_id = self.client.create_multipart_upload(
+            Bucket=self.bucket, Key=self.key)["UploadId"]
+        started = UploadSession.objects.filter(
+            pk=session.pk,
+            multipart_id=""
+        ).update(
+            multipart_id=upload_id,
+            multipart_box_id=self.storage_box_id,
+            multipart_bucket=self.bucket,
+            multipart_key=self.key)
+        if started == 0:
+            # Started by concurrent request
+            self.abort(upload_id)
+        session.refresh_from_db(fields=[
+            "multipart_id", "multipart_box_id",
+            "multipart_bucket", "multipart_key"])
+        return session.multipart_id
+
+    def put_part(self, upload_id, part_number, stream, length, hasher,
+                 checksum, algorithm):
+        """
+        Receive chunk into a temporary file and send it as a part
+        once the checksum matches.
+        Returns (number of bytes received, part ETag or None).
+        """
+        block_size = getattr(settings, "CHUNK_STREAM_SIZE", 1000000)
+        with tempfile.SpooledTemporaryFile(max_size=block_size) as part:
+            received = utils.copy_stream(
+                stream, part.write, length, hasher, block_size)
+            if received != length or \
+                    hasher.hexdigests()[algorithm] != checksum:
+                return received, None
+            part.seek(0)
+            etag = self.client.upload_part(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=upload_id,
+                PartNumber=part_number,
+                ContentLength=length,
+                Body=part)["ETag"]
+        return received, etag
+
+    def compose(self, upload_id, parts):
+        """
+        Complete multipart upload from list of (part number, ETag),
+        upload completed before counts as composed if the object exists
+        """
+        try:
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=upload_id,
+                MultipartUpload={"Parts": [
+                    {"PartNumber": part_number, "ETag": etag}
+                    for part_number, etag in sorted(parts)]})
+        except Exception as e:
+            if get_error_code(e) != "NoSuchUpload":
+                raise
+            # Raises if the object doesn't exist
+            self.client.head_object(Bucket=self.bucket, Key=self.key)
+            logger.info("Multipart upload %s completed before" % upload_id)
+
+    def abort(self, upload_id):
+        try:
+            self.client.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=upload_id)
+        except Exception as e:
+            logger.error(str(e))
+
+
+def get_object_storage(storage_box):
+    """
+    Initialised storage of S3-compatible storage box, None for other boxes
+    """
+    storage = storage_box.get_initialised_storage_instance()
+    if not hasattr(storage, "bucket_name") or \
+            not hasattr(storage, "connection"):
+        return None
+    return storage
+
+
+def get_object_store(dfo):
+    """
+    Chunk store for DataFileObject in S3-compatible storage box,
+    None if chunks have to be staged locally
+    """
+    if not getattr(settings, "CHUNK_OBJECT_STAGING", False):
+        return None
+    storage = get_object_storage(dfo.storage_box)
+    if storage is None:
+        return None
+    key = dfo.uri
+    location = getattr(storage, "location", "")
+    if location:
+        key = posixpath.join(location, key)
+    return ObjectChunkStore(
+        storage.connection.meta.client, storage.bucket_name, key,
+        dfo.storage_box.id)
+
+
+def get_session_store(session):
+    """
+    Chunk store of multipart upload of the session, found from the
+    location recorded when the upload started, so the upload can be
+    aborted once its DataFileObject is removed.
+    None if the storage box is gone too.
+    """
+    if not session.multipart_id or session.multipart_box_id is None:
+        return None
+    storage_box = StorageBox.objects.filter(
+        id=session.multipart_box_id).first()
+    if storage_box is None:
+        return None
+    storage = get_object_storage(storage_box)
+    if storage is None:
+        return None
+    return ObjectChunkStore(
+        storage.connection.meta.client, session.multipart_bucket,
+        session.multipart_key, storage_box.id)
@@ -3,3 +3,29 @@ CHUNK_MAX_SIZE = 100000000  # 100MB
 CHUNK_CHECKSUM = "xxh3_64"
 CHUNK_STORAGE = "/var/store/chunks/"
 CHUNK_COPY_SIZE = 10000000  # 10MB
+CHUNK_STREAM_SIZE = 1000000  # 1MB
+CHUNK_DIRECT_PLACEMENT = False  # Write chunks straight into data file
+CHUNK_PREALLOCATE = "sparse"  # "sparse" or "fallocate"
+CHUNK_ASSEMBLY_THREADS = 1  # Overridden by "chunk_assembly_threads" attribute
+CHUNK_ASSEMBLY_TIMEOUT = 3600  # Seconds before stuck assembly is retried
+CHUNK_FULL_SWEEP_INTERVAL = 3600  # Seconds between checks of all uploads
+CHUNK_VERIFY_INLINE = True  # Otherwise run dfo_verify after assembly
+CHUNK_CHECKSUMS = ["xxh3_64", "xxh128", "crc32c", "md5", "sha256"]
+CHUNK_DEDUP = False  # Share identical chunks between uploads
+CHUNK_DEDUP_CHECKSUM = "sha256"  # Identifies stored chunk content
+CHUNK_STORAGE_ROOTS = []  # Staging folders used instead of CHUNK_STORAGE
+CHUNK_STORAGE_POLICY = "round_robin"  # "least_used" or "same_device"
+CHUNK_OBJECT_STAGING = False  # Send chunks as multipart upload parts to S3
+CHUNK_RESERVE_MARGIN = 0  # Staging space in bytes kept free
+CHUNK_RESERVATION_TIMEOUT = 86400  # Seconds idle upload keeps its space
+CHUNK_RETRY_AFTER = 60  # Seconds client waits when upload is refused
+CHUNK_MAX_CONCURRENT_PER_INSTRUMENT = 0  # Chunks in flight, 0 is unlimited
+CHUNK_MAX_CONCURRENT_PER_USER = 0
+CHUNK_MAX_RATE_PER_INSTRUMENT = 0  # Bytes per second, 0 is unlimited
+CHUNK_MAX_RATE_PER_USER = 0
+CHUNK_RATE_WINDOW = 10  # Seconds over which upload rate is measured
+CHUNK_THROTTLE_TIMEOUT = 3600  # Seconds before lost concurrency slots expire
+CHUNK_TOKEN_MAX_AGE = 3600  # Seconds upload token from get_chunks is valid
+MYDATA_PERMISSION_CACHE_TTL = 30  # Seconds authorization decisions are kept
+MYDATA_PERMISSION_CACHE_SIZE = 10000  # Decisions kept per process
+MYDATA_STORAGE_BOX_CACHE_TTL = 300  # Seconds uploader storage box is kept
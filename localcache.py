@@ -0,0 +1,49 @@
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+class LocalCache:
+    """
+    Process-local cache of computed values which expire after ttl_setting
+    seconds, dropped in every process when generation counter kept
+    in Django cache is bumped by invalidate
+    """
+
+    def __init__(self, generation_key, ttl_setting, ttl=30, size=10000):
+        self.generation_key = generation_key
+        self.ttl_setting = ttl_setting
+        self.ttl = ttl
+        self.size = size
+        self.values = {}  # key: (expiry, generation, value)
+
+    def get_generation(self):
+        return cache.get(self.generation_key, 0)
+
+    def get(self, key, compute, generation=None):
+        """
+        Cached value of key, calling compute if it is missing or stale.
+        None stands for a failed computation and is not kept.
+        """
+        if generation is None:
+            generation = self.get_generation()
+        ttl = getattr(settings, self.ttl_setting, self.ttl)
+        now = time.monotonic()
+        entry = self.values.get(key)
+        if entry is not None and entry[0] > now and entry[1] == generation:
+            return entry[2]
+        value = compute()
+        if ttl > 0 and value is not None:
+            if len(self.values) >= self.size:
+                self.values.clear()
+            self.values[key] = (now + ttl, generation, value)
+        return value
+
+    def invalidate(self):
+        if not cache.add(self.generation_key, 1, None):
+            try:
+                cache.incr(self.generation_key)
+            except ValueError:
+                cache.add(self.generation_key, 1, None)
+        self.values.clear()
@@ -0,0 +1,98 @@
+import os
+import shutil
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+
+from ... import utils
+
+
+class Command(BaseCommand):
+    help = ('Compares throughput of chunked upload assembly methods '
+            'using generated chunk files')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--size', type=int, default=2*1024**3,
+            help='Total file size in bytes (default 2GB)')
+        parser.add_argument(
+            '--chunk-size', type=int, default=100000000,
+            help='Chunk size in bytes (default 100MB)')
+        parser.add_argument(
+            '--copy-size', type=int, default=10000000,
+            help='Copy buffer size in bytes (default 10MB)')
+        parser.add_argument(
+            '--threads', default='1,2,4,8',
+            help='Comma-separated thread counts for parallel assembly '
+                 '(default 1,2,4,8)')
+        parser.add_argument(
+            '--path', default=None,
+            help='Folder for benchmark files (default system temp folder)')
+
+    def handle(self, *args, **options):
+        path = tempfile.mkdtemp(prefix='mydata-benchmark-', dir=options['path'])
+        try:
+            chunks = self.make_chunks(
+                path, options['size'], options['chunk_size'])
+            methods = [('buffered', self.assemble_buffered, 1)]
+            for threads in options['threads'].split(','):
+                threads = int(threads)
+                methods.append((
+                    'kernel %s threads' % threads,
+                    self.assemble_kernel,
+                    threads))
+            for name, method, threads in methods:
+                dst_path = os.path.join(path, 'assembled')
+                start = time.time()
+                method(chunks, dst_path, options['copy_size'], threads)
+                elapsed = max(time.time() - start, 1e-9)
+                self.stdout.write("%s: %.1f MB/s (%.2f s)\n" % (
+                    name, options['size'] / elapsed / 1000000, elapsed))
+                os.remove(dst_path)
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def make_chunks(self, path, size, chunk_size):
+        '''
+        Generate chunk files, returns list of (offset, size, path)
+        '''
+        block = os.urandom(min(chunk_size, 1000000))
+        chunks = []
+        offset = 0
+        while offset < size:
+            length = min(chunk_size, size - offset)
+            file_path = os.path.join(path, 'chunk-%s' % len(chunks))
+            with open(file_path, 'wb') as chunk:
+                written = 0
+                while written < length:
+                    written += chunk.write(block[:length - written])
+            chunks.append((offset, length, file_path))
+            offset += length
+        return chunks
+
+    def assemble_buffered(self, chunks, dst_path, copy_size, threads):
+        '''
+        Assembly through Python read/write loop
+        '''
+        with open(dst_path, 'wb') as dst:
+            for _, _, file_path in chunks:
+                with open(file_path, 'rb') as src:
+                    while True:
+                        data = src.read(copy_size)
+                        dst.write(data)
+                        if len(data) != copy_size:
+                            break
+
+    def assemble_kernel(self, chunks, dst_path, copy_size, threads):
+        '''
+        Assembly with kernel-side copy, as done by complete_chunked_upload
+        '''
+        with open(dst_path, 'wb'):
+            pass
+        utils.assemble_file(
+            dst_path,
+            [(file_path, offset, length)
+             for offset, length, file_path in chunks],
+            threads,
+            copy_size)
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mydata', '0006_chunk'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chunk',
+            name='placed',
+            field=models.BooleanField(default=False),
+        ),
+    ]
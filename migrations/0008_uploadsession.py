@@ -0,0 +1,25 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mydata', '0007_chunk_placed'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UploadSession',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dfo_id', models.IntegerField(unique=True)),
+                ('size', models.BigIntegerField()),
+                ('chunk_size', models.BigIntegerField()),
+                ('received', models.BigIntegerField(default=0)),
+                ('coverage', models.BinaryField(default=b'')),
+                ('state', models.CharField(choices=[('receiving', 'Receiving'), ('assembling', 'Assembling'), ('verifying', 'Verifying'), ('done', 'Done'), ('failed', 'Failed')], default='receiving', max_length=16)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
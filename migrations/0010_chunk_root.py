@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mydata', '0009_chunkcontent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chunk',
+            name='root',
+            field=models.CharField(default='', max_length=255),
+        ),
+    ]
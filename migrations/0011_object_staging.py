@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mydata', '0010_chunk_root'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chunk',
+            name='etag',
+            field=models.CharField(default='', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='uploadsession',
+            name='multipart_id',
+            field=models.CharField(default='', max_length=255),
+        ),
+    ]
@@ -0,0 +1,23 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mydata', '0012_uploadsession_reserved'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StagingRoot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('path', models.CharField(max_length=255, unique=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='uploadsession',
+            name='root',
+            field=models.CharField(default='', max_length=255),
+        ),
+    ]
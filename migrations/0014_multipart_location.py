@@ -0,0 +1,26 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mydata', '0013_stagingroot'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='uploadsession',
+            name='multipart_box_id',
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name='uploadsession',
+            name='multipart_bucket',
+            field=models.CharField(default='', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='uploadsession',
+            name='multipart_key',
+            field=models.CharField(default='', max_length=1024),
+        ),
+    ]
@@ -1,4 +1,109 @@
-from django.db import models
+import os
+
+from django.conf import settings
+from django.db import models, transaction, IntegrityError
+
+from .. import utils
+
+
+class ChunkContent(models.Model):
+    """
+    Chunk data stored once by its digest and shared between uploads
+    """
+
+    digest = models.CharField(max_length=128, unique=True, null=False)
+    size = models.BigIntegerField(null=False)
+    refs = models.IntegerField(default=0)  # Chunks using the content
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        app_label = "mydata"
+
+    def __str__(self):
+        return self.digest
+
+    @staticmethod
+    def get_content_path(digest):
+        return os.path.join(
+            settings.CHUNK_STORAGE, "content", digest[:2], digest)
+
+    def get_path(self):
+        return self.get_content_path(self.digest)
+
+    @classmethod
+    def lock(cls, digest, size, create=False):
+        """
+        Lock content by digest until the end of the transaction,
+        adding its row if create is set, otherwise the content file
+        must be stored already.
+        Content files are only changed under the row lock, so they are never
+        removed while another upload stores or links the content.
+        """
+        while True:
+            content = cls.objects.select_for_update().filter(
+                digest=digest).first()
+            if content is not None or not create:
+                break
+            try:
+                with transaction.atomic():
+                    cls.objects.create(digest=digest, size=size)
+            except IntegrityError:
+                # Stored by concurrent upload, wait for its lock
+                pass
+
+        if content is None or \
+                not create and not os.path.exists(content.get_path()):
+            raise cls.DoesNotExist("Chunk content not found.")
+
+        return content
+
+    def store(self, file_path):
+        """
+        Move verified chunk file into content store, file_path duplicating
+        stored content is removed.
+        Called under the row lock once the chunk using the content is
+        recorded, so an upload which fails to record its chunk doesn't
+        leave a content file without a row.
+        """
+        content_path = self.get_path()
+        if os.path.exists(content_path):
+            os.remove(file_path)
+            return
+        os.makedirs(
+            os.path.dirname(content_path), mode=0o770, exist_ok=True)
+        # Staging root might be on another device
+        utils.move_file(file_path, content_path)
+
+    def add_ref(self):
+        ChunkContent.objects.filter(
+            pk=self.pk).update(refs=models.F("refs") + 1)
+
+    def release(self):
+        """
+        Drop reference to the content, removing it when no longer used
+        """
+        with transaction.atomic():
+            content = ChunkContent.objects.select_for_update().filter(
+                pk=self.pk).first()
+            if content is None:
+                return
+            content.refs -= 1
+            content.save(update_fields=["refs"])
+            content.remove_unused()
+
+    def remove_unused(self):
+        """
+        Remove content no chunk uses, the row must be locked by the caller
+        """
+        if self.refs > 0 or \
+                Chunk.objects.filter(content_id=self.pk).exists():
+            return False
+        self.delete()
+        try:
+            os.remove(self.get_path())
+        except FileNotFoundError:
+            pass
+        return True
 
 
 class Chunk(models.Model):
@@ -13,6 +118,11 @@ class Chunk(models.Model):
     created = models.DateTimeField(auto_now_add=True)
     instrument_id = models.IntegerField(null=True)  # Might be uploaded manually
     user_id = models.IntegerField(null=False)
+    placed = models.BooleanField(default=False)  # Written into data file
+    content = models.ForeignKey(
+        ChunkContent, null=True, on_delete=models.PROTECT)  # Deduplicated
+    root = models.CharField(max_length=255, default="")  # Staging root
+    etag = models.CharField(max_length=255, default="")  # Object storage part
 
     class Meta:
         app_label = "mydata"
@@ -21,3 +131,13 @@ class Chunk(models.Model):
 
     def __str__(self):
         return str(self.dfo_id) + ":" + self.chunk_id
+
+    def get_path(self):
+        """
+        Location of the chunk data, unless written into data file
+        """
+        if self.content_id is not None:
+            return ChunkContent.get_content_path(self.content.digest)
+        return os.path.join(
+            self.root or settings.CHUNK_STORAGE, str(self.dfo_id),
+            self.chunk_id)
@@ -0,0 +1,231 @@
+import math
+from datetime import timedelta
+
+from django.db import models, transaction, IntegrityError
+from django.db.models import Q
+from django.utils import timezone
+
+from .chunk import Chunk
+from .. import utils
+
+
+class UploadSession(models.Model):
+    """
+    State of a chunked upload of a file by MyData app,
+    updated as chunks land so upload status is a single row lookup
+    """
+
+    RECEIVING = "receiving"
+    ASSEMBLING = "assembling"
+    VERIFYING = "verifying"
+    DONE = "done"
+    FAILED = "failed"
+    STATES = (
+        (RECEIVING, "Receiving"),
+        (ASSEMBLING, "Assembling"),
+        (VERIFYING, "Verifying"),
+        (DONE, "Done"),
+        (FAILED, "Failed")
+    )
+
+    dfo_id = models.IntegerField(unique=True, null=False)
+    size = models.BigIntegerField(null=False)
+    chunk_size = models.BigIntegerField(null=False)
+    received = models.BigIntegerField(default=0)
+    reserved = models.BigIntegerField(default=0)  # Staging space
+    root = models.CharField(max_length=255, default="")  # Staging root
+    coverage = models.BinaryField(default=b"")  # Bit per received chunk
+    state = models.CharField(max_length=16, choices=STATES, default=RECEIVING)
+    multipart_id = models.CharField(max_length=255, default="")  # S3 upload
+    # Where the multipart upload goes, so it can be aborted without the DFO
+    multipart_box_id = models.IntegerField(null=True)
+    multipart_bucket = models.CharField(max_length=255, default="")
+    multipart_key = models.CharField(max_length=1024, default="")
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        app_label = "mydata"
+
+    def __str__(self):
+        return str(self.dfo_id) + ":" + self.state
+
+    @classmethod
+    def from_chunks(cls, dfo_id, size, chunk_size):
+        """
+        Unsaved upload session of DataFileObject, taking into account
+        chunks uploaded before sessions existed
+        """
+        chunks = list(Chunk.objects.filter(
+            dfo_id=dfo_id
+        ).order_by("offset").values_list("offset", "size"))
+        if len(chunks) != 0:
+            chunk_size = chunks[0][1]
+
+        session = cls(dfo_id=dfo_id, size=size, chunk_size=chunk_size)
+        for offset, length in chunks:
+            if session.is_aligned(offset, length):
+                session.set_chunk(offset, length)
+
+        return session
+
+    @classmethod
+    def get_or_describe(cls, dfo_id, size, chunk_size):
+        """
+        Get upload session of DataFileObject without starting one,
+        so status requests don't write to the database
+        """
+        session = cls.objects.filter(dfo_id=dfo_id).first()
+        if session is None:
+            session = cls.from_chunks(dfo_id, size, chunk_size)
+        return session
+
+    @classmethod
+    def get_or_start(cls, dfo_id, size, chunk_size):
+        """
+        Get upload session of DataFileObject or start a new one
+        """
+        try:
+            return cls.objects.get(dfo_id=dfo_id)
+        except cls.DoesNotExist:
+            pass
+
+        session = cls.from_chunks(dfo_id, size, chunk_size)
+        try:
+            with transaction.atomic():
+                session.save()
+        except IntegrityError:
+            # Started by concurrent request
+            return cls.objects.get(dfo_id=dfo_id)
+
+        return session
+
+    @property
+    def chunks_count(self):
+        return math.ceil(self.size/self.chunk_size)
+
+    def chunk_index(self, offset):
+        return offset // self.chunk_size
+
+    def is_aligned(self, offset, length):
+        """
+        Check chunk matches chunk boundaries of the upload
+        """
+        return offset % self.chunk_size == 0 and \
+            offset < self.size and \
+            length == min(self.chunk_size, self.size - offset)
+
+    @staticmethod
+    def _is_set(coverage, index):
+        return index // 8 < len(coverage) and \
+            coverage[index // 8] & (1 << index % 8) != 0
+
+    def has_chunk(self, offset):
+        return self._is_set(bytes(self.coverage), self.chunk_index(offset))
+
+    def set_chunk(self, offset, length):
+        """
+        Mark chunk as received, returns False if it was received before
+        """
+        if self.has_chunk(offset):
+            return False
+        index = self.chunk_index(offset)
+        coverage = bytearray(self.coverage)
+        if len(coverage) <= index // 8:
+            coverage.extend(bytes(index // 8 - len(coverage) + 1))
+        coverage[index // 8] |= 1 << index % 8
+        self.coverage = bytes(coverage)
+        self.received += length
+        return True
+
+    def add_chunk(self, offset, length):
+        """
+        Atomically mark chunk as received in the database
+        """
+        with transaction.atomic():
+            session = UploadSession.objects.select_for_update().get(
+                pk=self.pk)
+            if session.set_chunk(offset, length):
+                session.save(update_fields=["coverage", "received", "updated"])
+        self.coverage = session.coverage
+        self.received = session.received
+
+    def received_chunks(self):
+        """
+        Received chunks as (offset, size) pairs ordered by offset
+        """
+        coverage = bytes(self.coverage)
+        return [
+            (index * self.chunk_size,
+             min(self.chunk_size, self.size - index * self.chunk_size))
+            for index in range(self.chunks_count)
+            if self._is_set(coverage, index)
+        ]
+
+    def missing_ranges(self):
+        """
+        Byte ranges of the file not received yet, as list of [start, end)
+        """
+        return utils.missing_ranges(self.received_chunks(), self.size)
+
+    def is_complete(self):
+        return self.received >= self.size and len(self.missing_ranges()) == 0
+
+    def is_accepting(self):
+        """
+        Check upload takes chunks, rather than being assembled or verified
+        """
+        return self.state in (self.RECEIVING, self.FAILED)
+
+    def is_lost(self, timeout):
+        """
+        Check assembled file wasn't verified within timeout seconds,
+        it failed verification then and has to be uploaded again,
+        as chunks are removed once the file is assembled
+        """
+        return self.state == self.VERIFYING and \
+            self.updated < timezone.now() - timedelta(seconds=timeout)
+
+    def claim(self, timeout):
+        """
+        Take the upload for assembly, so only one task can process the file.
+        Assembly not finished within timeout seconds is considered lost
+        and might be taken again.
+        """
+        now = timezone.now()
+        claimed = UploadSession.objects.filter(
+            Q(state__in=[self.RECEIVING, self.FAILED]) |
+            Q(state=self.ASSEMBLING,
+              updated__lt=now - timedelta(seconds=timeout)),
+            pk=self.pk
+        ).update(state=self.ASSEMBLING, updated=now)
+        if claimed != 0:
+            self.state = self.ASSEMBLING
+            self.updated = now
+        return claimed != 0
+
+    def set_state(self, state):
+        self.state = state
+        self.save(update_fields=["state", "updated"])
+
+
+class StagingRoot(models.Model):
+    """
+    Staging root folder, locked while staging space is reserved on it
+    """
+
+    path = models.CharField(max_length=255, unique=True, null=False)
+
+    class Meta:
+        app_label = "mydata"
+
+    def __str__(self):
+        return self.path
+
+    @classmethod
+    def lock(cls, path):
+        """
+        Lock staging root until the end of the transaction
+        """
+        cls.objects.get_or_create(path=path)
+        return cls.objects.select_for_update().get(path=path)
@@ -0,0 +1,44 @@
+from django.conf import settings
+
+from .localcache import LocalCache
+
+
+# Authorization decisions, dropped on ACL and facility changes.
+# Changes are signalled through a generation counter in Django cache,
+# which must be shared between processes (memcached, redis), otherwise
+# other processes keep stale decisions until they expire.
+# Queryset updates and bulk ACL changes don't send model signals, so
+# decisions may stay stale for up to MYDATA_PERMISSION_CACHE_TTL seconds.
+decisions = LocalCache(
+    "mydata_permission_generation",
+    "MYDATA_PERMISSION_CACHE_TTL",
+    size=getattr(settings, "MYDATA_PERMISSION_CACHE_SIZE", 10000))
+
+
+def invalidate():
+    """
+    Drop cached authorization decisions in every process
+    """
+    decisions.invalidate()
+
+
+def cached_permission(request, key, compute):
+    """
+    Authorization decision for key, computed once per request and kept
+    for MYDATA_PERMISSION_CACHE_TTL seconds in the process.
+    compute returns None if the decision can't be made, which is
+    retried on the next request rather than kept.
+    """
+    memo = getattr(request, "_mydata_permissions", None)
+    if memo is None:
+        memo = {}
+        request._mydata_permissions = memo
+    if key in memo:
+        return memo[key]
+
+    if "generation" not in memo:
+        memo["generation"] = decisions.get_generation()
+    value = decisions.get(key, compute, memo["generation"])
+
+    memo[key] = value
+    return value
@@ -0,0 +1,44 @@
+from django.contrib.auth.models import User
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.dispatch import receiver
+
+from tardis.tardis_portal.models.access_control import ObjectACL
+from tardis.tardis_portal.models.dataset import Dataset
+from tardis.tardis_portal.models.facility import Facility
+from tardis.tardis_portal.models.storage import StorageBox
+
+from .models.uploader import Uploader, UploaderRegistrationRequest
+from .api.datafile import storage_boxes
+from . import permissions
+
+
+@receiver(post_save, sender=ObjectACL)
+@receiver(post_delete, sender=ObjectACL)
+@receiver(post_save, sender=Facility)
+@receiver(post_delete, sender=Facility)
+def acl_changed(sender, **kwargs):
+    permissions.invalidate()
+
+
+@receiver(m2m_changed, sender=User.groups.through)
+@receiver(m2m_changed, sender=User.user_permissions.through)
+@receiver(m2m_changed, sender=Dataset.experiments.through)
+def membership_changed(sender, action, **kwargs):
+    if action.startswith("post_"):
+        permissions.invalidate()
+
+
+@receiver(post_save, sender=Uploader)
+@receiver(post_delete, sender=Uploader)
+@receiver(post_save, sender=UploaderRegistrationRequest)
+@receiver(post_delete, sender=UploaderRegistrationRequest)
+@receiver(post_save, sender=StorageBox)
+@receiver(post_delete, sender=StorageBox)
+def uploader_changed(sender, **kwargs):
+    storage_boxes.invalidate()
+
+
+@receiver(m2m_changed, sender=Uploader.instruments.through)
+def uploader_instruments_changed(sender, action, **kwargs):
+    if action.startswith("post_"):
+        storage_boxes.invalidate()
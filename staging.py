@@ -0,0 +1,145 @@
+import os
+import shutil
+import itertools
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files.storage import FileSystemStorage, get_storage_class
+from django.db import transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from .models.upload import UploadSession, StagingRoot
+
+
+logger = logging.getLogger(__name__)
+
+# Next root for round robin placement within the process
+_round_robin = itertools.count()
+
+
+def get_staging_roots():
+    """
+    Folders chunks might be staged in, CHUNK_STORAGE unless
+    CHUNK_STORAGE_ROOTS is set
+    """
+    roots = getattr(settings, "CHUNK_STORAGE_ROOTS", None)
+    if not roots:
+        return [settings.CHUNK_STORAGE]
+    return list(roots)
+
+
+def get_existing(path):
+    """
+    Path or its closest existing parent folder
+    """
+    while not os.path.exists(path) and os.path.dirname(path) != path:
+        path = os.path.dirname(path)
+    return path
+
+
+def get_device(path):
+    return os.stat(get_existing(path)).st_dev
+
+
+def round_robin(roots, dfo):
+    return roots[next(_round_robin) % len(roots)]
+
+
+def least_used(roots, dfo):
+    """
+    Root with the most free space
+    """
+    def free_space(root):
+        try:
+            return shutil.disk_usage(get_existing(root)).free
+        except OSError as e:
+            logger.error(str(e))
+            return -1
+    return max(roots, key=free_space)
+
+
+def same_device(roots, dfo):
+    """
+    Root on the file system of the data file, so assembly copies stay
+    within one device, otherwise round robin.
+    Data files in other than filesystem storage have no device.
+    """
+    storage_class = get_storage_class(dfo.storage_box.django_storage_class)
+    if not issubclass(storage_class, FileSystemStorage):
+        return round_robin(roots, dfo)
+    device = get_device(dfo.get_full_path())
+    matching = [root for root in roots if get_device(root) == device]
+    return round_robin(matching or roots, dfo)
+
+
+STAGING_POLICIES = {
+    "round_robin": round_robin,
+    "least_used": least_used,
+    "same_device": same_device
+}
+
+
+def choose_staging_root(dfo):
+    """
+    Staging root for a chunk of the DataFileObject,
+    chosen with CHUNK_STORAGE_POLICY
+    """
+    roots = get_staging_roots()
+    if len(roots) == 1:
+        return roots[0]
+    policy = getattr(settings, "CHUNK_STORAGE_POLICY", "round_robin")
+    if policy not in STAGING_POLICIES:
+        raise ImproperlyConfigured(
+            "Unknown CHUNK_STORAGE_POLICY %s, expected one of %s" % (
+                policy, ", ".join(sorted(STAGING_POLICIES))))
+    return STAGING_POLICIES[policy](roots, dfo)
+
+
+def get_reserved_space(root=None):
+    """
+    Staging space reserved and not used yet by active uploads,
+    on the staging root if given
+    """
+    since = timezone.now() - timedelta(
+        seconds=getattr(settings, "CHUNK_RESERVATION_TIMEOUT", 86400))
+    sessions = UploadSession.objects.filter(
+        state__in=[UploadSession.RECEIVING, UploadSession.FAILED],
+        reserved__gt=F("received"),
+        updated__gte=since
+    )
+    if root is not None:
+        sessions = sessions.filter(root=root)
+    reserved = sessions.aggregate(
+        total=Sum(F("reserved") - F("received")))["total"]
+    return reserved or 0
+
+
+def reserve_space(session, root):
+    """
+    Reserve space on staging root for the whole upload on its first chunk,
+    returns False if the staging volume can't take the rest of it.
+    Reservations on a root are made one at a time, so concurrent uploads
+    can't take the same free space. All chunks of the upload are staged
+    on the root of the reservation, kept in session.root.
+    """
+    if session.reserved != 0:
+        return True
+    needed = session.size - session.received + \
+        getattr(settings, "CHUNK_RESERVE_MARGIN", 0)
+    with transaction.atomic():
+        StagingRoot.lock(root)
+        free = shutil.disk_usage(get_existing(root)).free
+        if free - get_reserved_space(root) < needed:
+            logger.warning(
+                "Staging space for upload %s refused" % session.dfo_id)
+            return False
+        UploadSession.objects.filter(
+            pk=session.pk,
+            reserved=0
+        ).update(reserved=session.size, root=root)
+    # Concurrent chunk of the upload might have reserved another root
+    session.refresh_from_db(fields=["reserved", "root"])
+    return True
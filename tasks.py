@@ -1,30 +1,51 @@
 import os
 import math
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 
 from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
+from django.db.models import F, Q
 
 from tardis.celery import tardis_app
 from tardis.tardis_portal import tasks
 
 from tardis.tardis_portal.models.datafile import DataFileObject
-from .models.chunk import Chunk
+from .models.chunk import Chunk, ChunkContent
+from .models.upload import UploadSession
+from . import utils
+from . import chunkstore
 
 
 logger = logging.getLogger(__name__)
 
+# Last time chunks_complete looked for complete uploads
+SWEEP_WATERMARK_KEY = "mydata_chunks_complete_watermark"
+
+# Set until chunks_complete has to look at all uploads again
+FULL_SWEEP_KEY = "mydata_chunks_complete_full_sweep"
+
+# Set while complete_chunked_upload task is queued for the file
+COMPLETE_TASK_KEY = "mydata_complete_chunked_upload_%s"
+
 
 @tardis_app.task(name="tardis_portal.complete_chunked_upload", ignore_result=True)
 def complete_chunked_upload(dfo_id):
     """
     Assembly data file from chunks
     """
-    def make_file(dfo, chunk_ids, data_path, chunk_size):
+    def make_file(dfo, chunks, algorithms):
         """
-        Reassembly file from chunks
+        Reassembly file from chunks, calculating checksums of the algorithms
+        from staged chunk files if the whole file is made from them.
+        Returns hasher with file checksums or None.
         """
-        for chunk_id in chunk_ids:
-            file_path = os.path.join(data_path, chunk_id)
+        staged = [chunk for chunk in chunks if not chunk.placed]
+        for chunk in staged:
+            file_path = chunk.get_path()
             if not os.path.exists(file_path):
                 raise Exception("Missing chunk file %s" % file_path)
 
@@ -35,59 +56,117 @@ def complete_chunked_upload(dfo_id):
         if not os.path.exists(dst_dir):
             os.makedirs(dst_dir)
 
-        # If destination file already exists,
-        # open file and seek to the last offset
-        if os.path.exists(dst_path):
-            file_size = os.stat(dst_path).st_size
-            chunks_offset = max(math.ceil(file_size/chunk_size) - 1, 0)
-            dst = open(dst_path, "rb+")  # pylint: disable=consider-using-with
-            dst.seek(chunks_offset * chunk_size)
-        else:
-            # Make new file
-            chunks_offset = 0
-            dst = open(dst_path, "wb")  # pylint: disable=consider-using-with
-
-        for chunk_id in chunk_ids[chunks_offset:]:
-            file_path = os.path.join(data_path, chunk_id)
-            logger.info("Complete file %s chunk %s" % (dfo.id, chunk_id))
-            with open(file_path, "rb") as src:
-                while True:
-                    data = src.read(settings.CHUNK_COPY_SIZE)
-                    dst.write(data)
-                    if len(data) != settings.CHUNK_COPY_SIZE:
-                        break
-
-        # Close the file
-        dst.close()
+        hasher = None
+        threads = get_assembly_threads(dfo.storage_box)
+
+        if len(staged) == len(chunks):
+            if os.path.exists(dst_path) and threads == 1:
+                # If destination file already exists,
+                # continue from the last offset.
+                # Chunks copied in order leave no gaps before it.
+                file_size = os.stat(dst_path).st_size
+                chunks_offset = max(math.ceil(file_size/chunks[0].size) - 1, 0)
+                staged = staged[chunks_offset:]
+            else:
+                # Make new file, parallel copies might have left gaps
+                # anywhere in an existing one, so all chunks are copied
+                with open(dst_path, "wb"):
+                    pass
+                if len(algorithms) != 0:
+                    hasher = utils.MultiHasher(algorithms)
+        # Otherwise some chunks were written straight into preallocated file
+        # and the rest must be copied at their offsets
+
+        logger.info("Complete file %s chunks %s threads %s" % (
+            dfo.id, len(staged), threads))
+        parts = [(chunk.get_path(), chunk.offset, chunk.size)
+                 for chunk in staged]
+        if hasher is None:
+            utils.assemble_file(
+                dst_path, parts, threads, settings.CHUNK_COPY_SIZE)
+            return None
+
+        # Chunk files are hashed in order while the kernel copies them,
+        # so copying stays zero-copy and parallel
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            assembly = pool.submit(
+                utils.assemble_file,
+                dst_path, parts, threads, settings.CHUNK_COPY_SIZE)
+            try:
+                utils.hash_files(hasher, [part[0] for part in parts])
+            finally:
+                assembly.result()
+
+        return hasher
 
     logger.info("Complete file %s" % dfo_id)
+    # Let another task be queued, running ones are excluded by session claim
+    cache.delete(COMPLETE_TASK_KEY % dfo_id)
     dfo = DataFileObject.objects.get(id=dfo_id)
     chunks = Chunk.objects.filter(dfo_id=dfo.id).order_by("offset")
-    chunk_ids = [chunk.chunk_id for chunk in chunks]
-    logger.debug("Complete file %s total chunks %s " % (dfo_id, len(chunk_ids)))
-    if len(chunk_ids) != 0:
-        data_path = os.path.join(settings.CHUNK_STORAGE, str(dfo.id))
+    chunk_list = list(chunks.select_related("content"))
+    logger.debug("Complete file %s total chunks %s " % (dfo_id, len(chunk_list)))
+    session = UploadSession.objects.filter(dfo_id=dfo.id).first()
+    if session is None and len(chunk_list) != 0:
+        session = UploadSession.get_or_start(
+            dfo.id, dfo.datafile.size, chunk_list[0].size)
+    if session is not None:
+        if len(chunk_list) != 0 and not session.is_complete():
+            logger.error("Complete file %s error missing chunks" % dfo_id)
+            return False
+        if not session.claim(get_assembly_timeout()):
+            logger.info("Complete file %s already in progress" % dfo_id)
+            return False
+    hasher = None
+    if session is not None and session.multipart_id:
+        # Parts are composed into the file by the object storage
+        try:
+            logger.debug("Complete file %s compose" % dfo_id)
+            store = chunkstore.get_object_store(dfo)
+            if store is None:
+                raise Exception("Object staging is not available")
+            store.compose(
+                session.multipart_id,
+                [(session.chunk_index(chunk.offset) + 1, chunk.etag)
+                 for chunk in chunk_list])
+        except Exception as e:
+            logger.error("Complete file %s error %s" % (dfo_id, str(e)))
+            session.set_state(UploadSession.FAILED)
+            return False
+        chunks.delete()
+        # Upload can't be composed again
+        UploadSession.objects.filter(pk=session.pk).update(multipart_id="")
+        session.multipart_id = ""
+    elif len(chunk_list) != 0:
         # Copy chunks to a final destination
         try:
             logger.debug("Complete file %s assembly" % dfo_id)
-            make_file(dfo, chunk_ids, data_path, chunks[0].size)
+            hasher = make_file(
+                dfo, chunk_list, get_verify_algorithms(dfo))
             logger.debug("Complete file %s file ready" % dfo.id)
         except Exception as e:
             logger.error("Complete file %s error %s" % (dfo_id, str(e)))
+            session.set_state(UploadSession.FAILED)
             return False
         # Cleanup
         logger.debug("Complete file %s cleanup" % dfo_id)
         chunks.delete()
-        for chunk_id in chunk_ids:
-            try:
-                os.remove(os.path.join(data_path, chunk_id))
-            except Exception as e:
-                logger.error(str(e))
-        # Folder must be empty
-        try:
-            os.rmdir(data_path)
-        except Exception as e:
-            logger.error(str(e))
+        remove_chunk_files(chunk_list)
+    if hasher is not None:
+        # Checksums were calculated while writing the file
+        logger.debug("Complete file %s verify checksums" % dfo_id)
+        if verify_checksums(dfo, hasher.hexdigests()):
+            session.set_state(UploadSession.DONE)
+            return True
+        # Upload has to start over, chunks are gone already and
+        # the corrupt file would be resumed from its size otherwise
+        logger.error("Complete file %s error checksum mismatch" % dfo_id)
+        session.delete()
+        remove_upload_file(dfo)
+        return False
+
+    if session is not None:
+        session.set_state(UploadSession.VERIFYING)
 
     # Verify file
     logger.debug("Complete file %s verify" % dfo_id)
@@ -98,23 +177,151 @@ def complete_chunked_upload(dfo_id):
     return True
 
 
+def remove_upload_file(dfo):
+    """
+    Remove assembled file which failed verification
+    """
+    try:
+        storage = dfo.storage_box.get_initialised_storage_instance()
+        if storage.exists(dfo.uri):
+            storage.delete(dfo.uri)
+    except Exception as e:
+        logger.error(str(e))
+
+
+def restart_upload(dfo_id):
+    """
+    Drop upload session and file of upload which wasn't verified within
+    assembly timeout, so the client uploads the file again.
+    Returns False if the upload isn't lost.
+    """
+    with transaction.atomic():
+        session = UploadSession.objects.select_for_update().filter(
+            dfo_id=dfo_id).first()
+        if session is None or not session.is_lost(get_assembly_timeout()):
+            return False
+        dfo = DataFileObject.objects.filter(id=dfo_id).first()
+        if dfo is not None:
+            if dfo.verified:
+                return False
+            logger.error("Complete file %s error verification failed" % dfo_id)
+            remove_upload_file(dfo)
+        session.delete()
+    return True
+
+
+def schedule_complete_upload(dfo_id):
+    """
+    Queue assembly task unless there is one queued for the file already.
+    Queued tasks are only known to processes sharing the Django cache
+    (memcached, redis), with a per-process cache duplicate tasks might
+    be queued and all but one of them exit on the upload session claim.
+    """
+    if cache.add(COMPLETE_TASK_KEY % dfo_id, True, get_assembly_timeout()):
+        complete_chunked_upload.apply_async(args=[dfo_id])
+        return True
+    return False
+
+
+def get_verify_algorithms(dfo):
+    """
+    Checksums to calculate while assembling the file,
+    empty list means the file is verified by dfo_verify task
+    """
+    if not getattr(settings, "CHUNK_VERIFY_INLINE", True):
+        return []
+    datafile = dfo.datafile
+    return [algorithm for algorithm, checksum in [
+        ("md5", datafile.md5sum),
+        ("sha512", datafile.sha512sum)] if checksum]
+
+
+def verify_checksums(dfo, checksums):
+    """
+    Compare checksums calculated on assembly with DataFile checksums
+    and mark DataFileObject verified if all of them match
+    """
+    datafile = dfo.datafile
+    expected = {
+        "md5": datafile.md5sum,
+        "sha512": datafile.sha512sum
+    }
+    if os.path.getsize(dfo.get_full_path()) != datafile.size:
+        return False
+    for algorithm, checksum in checksums.items():
+        if checksum.lower() != expected[algorithm].lower():
+            return False
+    dfo.verified = True
+    dfo.last_verified_time = timezone.now()
+    dfo.save(update_fields=["verified", "last_verified_time"])
+    return True
+
+
+def get_assembly_timeout():
+    return getattr(settings, "CHUNK_ASSEMBLY_TIMEOUT", 3600)
+
+
+def get_assembly_threads(storage_box):
+    """
+    Number of threads to assembly file in the storage box,
+    might be set with "chunk_assembly_threads" storage box attribute
+    """
+    threads = getattr(settings, "CHUNK_ASSEMBLY_THREADS", 1)
+    attribute = storage_box.attributes.filter(
+        key="chunk_assembly_threads").first()
+    if attribute is not None:
+        try:
+            threads = int(attribute.value)
+        except ValueError:
+            logger.error("Invalid chunk_assembly_threads for %s" % storage_box)
+    return max(threads, 1)
+
+
+def remove_chunk_files(chunks):
+    """
+    Remove staged chunk files and their folders in staging roots,
+    shared chunk content is released instead
+    """
+    staged = [chunk for chunk in chunks if not chunk.placed]
+    data_paths = set()
+    for chunk in staged:
+        try:
+            if chunk.content_id is not None:
+                chunk.content.release()
+            else:
+                file_path = chunk.get_path()
+                data_paths.add(os.path.dirname(file_path))
+                os.remove(file_path)
+        except Exception as e:
+            logger.error(str(e))
+    for data_path in data_paths:
+        if os.path.exists(data_path):
+            # Folder must be empty
+            try:
+                os.rmdir(data_path)
+            except Exception as e:
+                logger.error(str(e))
+
+
 @tardis_app.task(name="tardis_portal.remove_chunked_upload", ignore_result=True)
 def remove_chunked_upload(dfo_id):
     logger.debug("Remove incomplete upload %s" % dfo_id)
     chunks = Chunk.objects.filter(dfo_id=dfo_id).order_by("offset")
-    chunk_ids = [chunk.chunk_id for chunk in chunks]
-    if len(chunk_ids) != 0:
-        data_path = os.path.join(settings.CHUNK_STORAGE, str(dfo_id))
-        for chunk_id in chunk_ids:
-            try:
-                os.remove(os.path.join(data_path, chunk_id))
-            except Exception as e:
-                logger.error(str(e))
-        try:
-            os.rmdir(data_path)
-        except Exception as e:
-            logger.error(str(e))
+    chunk_list = list(chunks.select_related("content"))
+    if len(chunk_list) != 0:
+        # Content can't be released while chunks refer to it
         chunks.delete()
+        remove_chunk_files(chunk_list)
+    session = UploadSession.objects.filter(dfo_id=dfo_id).first()
+    if session is not None and session.multipart_id:
+        store = chunkstore.get_session_store(session)
+        if store is not None:
+            store.abort(session.multipart_id)
+        else:
+            logger.warning(
+                "Parts of upload %s are left to bucket lifecycle rules"
+                % dfo_id)
+    UploadSession.objects.filter(dfo_id=dfo_id).delete()
 
 
 @tardis_app.task(name="tardis_portal.chunks_cleanup", ignore_result=True)
@@ -122,27 +329,100 @@ def chunks_cleanup():
     """
     Find lost chunks (due to incomplete uploads) and cleanup
     """
-    uploads = Chunk.objects.order_by("dfo_id").values("dfo_id").distinct()
-    for upload in uploads:
-        dfo = DataFileObject.objects.filter(id=upload["dfo_id"])
-        if len(dfo) == 0:
-            remove_chunked_upload.apply_async(args=[upload["dfo_id"]])
+    dfo_ids = DataFileObject.objects.values("id")
+    uploads = Chunk.objects.exclude(
+        dfo_id__in=dfo_ids
+    ).order_by("dfo_id").values_list("dfo_id", flat=True).distinct()
+    queued = set()
+    for dfo_id in uploads.iterator():
+        remove_chunked_upload.apply_async(args=[dfo_id])
+        queued.add(dfo_id)
+    # Sessions of removed files, multipart uploads are aborted
+    # by the task before their sessions are removed
+    sessions = UploadSession.objects.exclude(dfo_id__in=dfo_ids)
+    for dfo_id in sessions.exclude(
+            multipart_id="").values_list("dfo_id", flat=True).iterator():
+        if dfo_id not in queued:
+            remove_chunked_upload.apply_async(args=[dfo_id])
+    sessions.filter(multipart_id="").delete()
+    # Sessions of finished uploads
+    UploadSession.objects.filter(
+        dfo_id__in=DataFileObject.objects.filter(
+            verified=True
+        ).values("id")
+    ).delete()
+    # Content stored by uploads which failed to record the chunk
+    unused = ChunkContent.objects.filter(
+        refs__lte=0,
+        chunk__isnull=True,
+        created__lt=timezone.now() - timedelta(seconds=get_assembly_timeout())
+    )
+    for content_id in unused.values_list("id", flat=True).iterator():
+        try:
+            with transaction.atomic():
+                content = ChunkContent.objects.select_for_update().filter(
+                    id=content_id).first()
+                if content is not None:
+                    content.remove_unused()
+        except Exception as e:
+            logger.error(str(e))
 
 
 @tardis_app.task(name="tardis_portal.chunks_complete", ignore_result=True)
 def chunks_complete():
     """
-    Find and try to complete uploads not processed straight after upload
-    """
-    uploads = Chunk.objects.order_by("dfo_id").values("dfo_id").distinct()
-    for upload in uploads:
-        dfo = DataFileObject.objects.filter(id=upload["dfo_id"])
-        if len(dfo) != 0:
-            last_chunk = Chunk.objects.filter(
-                dfo_id=dfo[0].id
-            ).order_by("-offset")[0]
-            offset = min(
-                last_chunk.offset+last_chunk.size,
-                dfo[0].datafile.size)
-            if offset == dfo[0].datafile.size:
-                complete_chunked_upload.apply_async(args=[dfo[0].id])
+    Find and try to complete uploads not processed straight after upload,
+    looking at uploads updated since the previous run, less the assembly
+    timeout to allow for clock skew and tasks still running.
+    Every CHUNK_FULL_SWEEP_INTERVAL seconds all uploads are checked,
+    including ones which were claimed by a lost assembly task and ones
+    started before upload sessions existed.
+    """
+    timeout = get_assembly_timeout()
+    now = timezone.now()
+    watermark = cache.get(SWEEP_WATERMARK_KEY)
+    cache.set(SWEEP_WATERMARK_KEY, now, None)
+    full_sweep = cache.add(
+        FULL_SWEEP_KEY, True,
+        getattr(settings, "CHUNK_FULL_SWEEP_INTERVAL", 3600))
+    sessions = UploadSession.objects.filter(
+        received__gte=F("size"),
+        dfo_id__in=DataFileObject.objects.filter(
+            verified=False
+        ).values("id")
+    )
+    if full_sweep or watermark is None:
+        sessions = sessions.filter(
+            Q(state__in=[UploadSession.RECEIVING, UploadSession.FAILED]) |
+            Q(state=UploadSession.ASSEMBLING,
+              updated__lt=now - timedelta(seconds=timeout)))
+    else:
+        sessions = sessions.filter(
+            state__in=[UploadSession.RECEIVING, UploadSession.FAILED],
+            updated__gte=watermark - timedelta(seconds=timeout))
+    for session in sessions.iterator():
+        if session.is_complete():
+            schedule_complete_upload(session.dfo_id)
+    if full_sweep or watermark is None:
+        # Uploads started before sessions existed get one from their chunks
+        legacy = DataFileObject.objects.filter(
+            verified=False,
+            id__in=Chunk.objects.exclude(
+                dfo_id__in=UploadSession.objects.values("dfo_id")
+            ).values("dfo_id")
+        ).values_list("id", "datafile__size")
+        for dfo_id, size in legacy.iterator():
+            # Chunk size is taken from the chunks
+            session = UploadSession.get_or_start(dfo_id, size, size or 1)
+            if session.is_complete():
+                schedule_complete_upload(dfo_id)
+        # Files which failed verification are uploaded again
+        lost = UploadSession.objects.filter(
+            state=UploadSession.VERIFYING,
+            updated__lt=now - timedelta(seconds=timeout),
+            dfo_id__in=DataFileObject.objects.filter(
+                verified=False
+            ).values("id")
+        ).values_list("dfo_id", flat=True)
+        for dfo_id in lost.iterator():
+            restart_upload(dfo_id)
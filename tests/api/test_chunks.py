@@ -1,13 +1,37 @@
 import os
 import json
+import gzip
+import hashlib
+from datetime import timedelta
+from unittest import mock
 
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, IntegrityError
 from django.test import override_settings
 from django.test.client import Client
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 
-from tardis.tardis_portal.models.storage import StorageBox
+from tardis.tardis_portal.models.storage import (
+    StorageBox,
+    StorageBoxAttribute
+)
+from tardis.tardis_portal import tasks
 from tardis.tardis_portal.models.datafile import DataFile, DataFileObject
-from ...models.chunk import Chunk
-from ...tasks import chunks_cleanup, chunks_complete
+from ...models.chunk import Chunk, ChunkContent
+from ...models.upload import UploadSession
+from ... import chunkstore
+from ... import staging
+from ... import throttling
+from ...tasks import (
+    chunks_cleanup,
+    chunks_complete,
+    complete_chunked_upload,
+    schedule_complete_upload,
+    COMPLETE_TASK_KEY,
+    FULL_SWEEP_KEY
+)
 
 from . import MyTardisResourceTestCase
 
@@ -62,6 +86,9 @@ class UploadAppResourceTest(MyTardisResourceTestCase):
             "Checksum": chunk[chksum],
             "Content-Range": chunk["range"]
         }
+        for name in ["Checksum-Algorithm", "Upload-Token"]:
+            if name in chunk:
+                headers[name] = chunk[name]
         with open(fname, "rb") as f:
             data = f.read()
         return self.client.post(
@@ -96,6 +123,116 @@ class UploadAppResourceTest(MyTardisResourceTestCase):
         self.assertEqual(data["offset"], 0)
         self.assertEqual(data["size"], 1000)
         self.assertEqual(data["checksum"], "md5")
+        self.assertEqual(data["checksums"][0], "md5")
+
+    @override_settings(CHUNK_MIN_SIZE=1000)
+    @override_settings(CHUNK_MAX_SIZE=1000)
+    @override_settings(CHUNK_CHECKSUM="md5")
+    @override_settings(CHUNK_STORAGE="/tmp")
+    def test_get_uploads(self):
+        self.upload_chunk(0)
+        response = self.client.post(
+            "/api/v1/mydata_upload/status/",
+            content_type="application/json",
+            data=json.dumps({"dfo_ids": [self.dfo.id, self.dfo.id+1]}))
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content)
+        self.assertTrue(data["success"])
+        upload = data["uploads"][str(self.dfo.id)]
+        self.assertTrue(upload["success"])
+        self.assertFalse(upload["completed"])
+        self.assertEqual(upload["offset"], 1000)
+        self.assertEqual(upload["size"], 1000)
+        self.assertEqual(upload["missing"], [[1000, 1553]])
+        upload = data["uploads"][str(self.dfo.id+1)]
+        self.assertFalse(upload["success"])
+        self.assertEqual(upload["error"], "Invalid object or access denied.")
+
+    @override_settings(CHUNK_MIN_SIZE=1000)
+    @override_settings(CHUNK_MAX_SIZE=1000)
+    @override_settings(CHUNK_CHECKSUM="md5")
+    @override_settings(CHUNK_STORAGE="/tmp")
+    def test_get_chunks_missing(self):
+        self.upload_chunk(1)
+        response = self.api_client.get(
+            "/api/v1/mydata_upload/%s/" % self.dfo.id,
+            authentication=self.get_credentials())
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content)
+        self.assertTrue(data["success"])
+        self.assertFalse(data["completed"])
+        self.assertEqual(data["offset"], 0)
+        self.assertEqual(data["missing"], [[0, 1000]])
+        self.upload_chunk(0)
+        response = self.api_client.get(
+            "/api/v1/mydata_upload/%s/" % self.dfo.id,
+            authentication=self.get_credentials())
+        data = json.loads(response.content)
+        self.assertTrue(data["completed"])
+
+    @override_settings(CHUNK_MIN_SIZE=1000)
+    @override_settings(CHUNK_MAX_SIZE=1000)
+    @override_settings(CHUNK_CHECKSUM="md5")
+    @override_settings(CHUNK_STORAGE="/tmp")
+    def test_upload_chunk_overlap(self):
+        self.upload_chunk(0)
+        response = self.upload_chunk(0)
+        data = json.loads(response.content)
+        self.assertFalse(data["success"])
+        self.assertEqual(data["error"], "Chunk already uploaded.")
+
+    @override_settings(CHUNK_MIN_SIZE=1000)
+    @override_settings(CHUNK_MAX_SIZE=1000)
+    @override_settings(CHUNK_CHECKSUM="md5")
+    @override_settings(CHUNK_STORAGE="/tmp")
+    @override_settings(CHUNK_DEDUP=True)
+    def test_upload_chunk_invalid_range(self):
+        self.chunks[0]["range"] = "bytes 0-1000/1553"
+        data = json.loads(self.upload_chunk(0).content)
+        self.assertEqual(data["error"], "Invalid 'Content-Range' in header.")
+        response = self.client.post(
+            "/api/v1/mydata_upload/%s/link/" % self.dfo.id,
+            **{"Checksum": "0" * 64, "Content-Range": "0-1000"})
+        data = json.loads(response.content)
+        self.assertEqual(data["error"], "Invalid 'Content-Range' in header.")
+
+    @override_settings(CHUNK_MIN_SIZE=1000)
+    @override_settings(CHUNK_MAX_SIZE=1000)
+    @override_settings(CHUNK_CHECKSUM="md5")
+    @override_settings(CHUNK_STORAGE="/tmp")
+    def test_upload_chunk_not_aligned(self):
+        self.chunks[1]["range"] = "1053-1553/1553"
+        response = self.upload_chunk(1)
+        data = json.loads(response.content)
+        self.assertFalse(data["success"])
+        self.assertEqual(
+            data["error"], "Chunk is not aligned to upload chunk size.")
+
+    @override_settings(CHUNK_MIN_SIZE=1000)
+    @override_settings(CHUNK_MAX_SIZE=1000)
+    @override_settings(CHUNK_CHECKSUM="md5")
+    @override_settings(CHUNK_STORAGE="/tmp")
+    def test_upload_session(self):
+        self.upload_chunk(1)
+        session = UploadSession.objects.get(dfo_id=self.dfo.id)
+        self.assertEqual(session.chunk_size, 1000)
+        self.assertEqual(session.received, 553)
+        self.assertEqual(session.state, UploadSession.RECEIVING)
+        self.upload_chunk(0)
+        session.refresh_from_db()
+        self.assertEqual(session.received, 1553)
+        self.assertTrue(session.is_complete())
+
+    @override_settings(CHUNK_MIN_SIZE=1000)
+    @override_settings(CHUNK_MAX_SIZE=1000)
+    @override_settings(CHUNK_CHECKSUM="md5")
+    def test_get_chunks_read_only(self):
+        response = self.api_client.get(
+            "/api/v1/mydata_upload/%s/" % self.dfo.id,
+            authentication=self.get_credentials())
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(
+            UploadSession.objects.filter(dfo_id=self.dfo.id).exists())
 
     @override_settings(CHUNK_MIN_SIZE=1000)
     @override_settings(CHUNK_MAX_SIZE=1000)
@@ -121,6 +258,54 @@ class UploadAppResourceTest(MyTardisResourceTestCase):
             self.assertIn(k, data)
         self.assertTrue(data["success"])
 
+    @override_settings(CHUNK_MIN_SIZE=1000)
+    @override_settings(CHUNK_MAX_SIZE=1000)
+    @override_settings(CHUNK_CHECKSUM="md5")
+    @override_settings(CHUNK_CHECKSUMS=["xxh3_64"])
+    @override_settings(CHUNK_STORAGE="/tmp")
+    def test_upload_chunk_checksum_algorithm(self):
+        self.chunks[0]["Checksum-Algorithm"] = "xxh3_64"
+        response = self.upload_chunk(0, "xxh64sum")
+        data = json.loads(response.content)
+        self.assertTrue(data["success"])
+        self.chunks[1]["Checksum-Algorithm"] = "sha256"
+        response = self.upload_chunk(1)
+        data = json.loads(response.content)
+        self.assertFalse(data["success"])
+        self.assertEqual(
+            data["error"], "Unsupported checksum algorithm sha256.")
+
+    @override_settings(CHUNK_MIN_SIZE=1000)
+    @override_settings(CHUNK_MAX_SIZE=1000)
+    @override_settings(CHUNK_CHECKSUM="md5")
+    @override_settings(CHUNK_STORAGE="/tmp")
+    @override_settings(CHUNK_STREAM_SIZE=100)
+    def test_upload_chunk_checksum_mismatch(self):
+        chunks_folder = os.path.join("/tmp", str(self.dfo.id))
+        self.chunks[0]["md5sum"] = self.chunks[1]["md5sum"]
+        response = self.upload_chunk(0)
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content)
+        self.assertFalse(data["success"])
+        self.assertTrue(data["error"].startswith("Checksum does not match."))
+        self.assertEqual(Chunk.objects.filter(dfo_id=self.dfo.id).count(), 0)
+        self.assertEqual(os.listdir(chunks_folder), [])
+
+    @override_settings(CHUNK_MIN_SIZE=1000)
+    @override_settings(CHUNK_MAX_SIZE=1000)
+    @override_settings(CHUNK_CHECKSUM="md5")
+    @override_settings(CHUNK_STORAGE="/tmp")
+    @override_settings(CHUNK_STREAM_SIZE=100)
+    def test_upload_chunk_size_mismatch(self):
+        self.chunks[1]["name"] = self.chunks[0]["name"]
+        response = self.upload_chunk(1)
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content)
+        self.assertFalse(data["success"])
+        self.assertEqual(
+            data["error"], "Chunk size does not match 'Content-Range'.")
+        self.assertEqual(Chunk.objects.filter(dfo_id=self.dfo.id).count(), 0)
+
     @override_settings(CHUNK_MIN_SIZE=1000)
     @override_settings(CHUNK_MAX_SIZE=1000)
     @override_settings(CHUNK_CHECKSUM="md5")
@@ -166,6 +351,103 @@ class UploadAppResourceTest(MyTardisResourceTestCase):
         dfo = DataFileObject.objects.get(id=self.dfo.id)
         self.assertTrue(dfo.verify())
 
+    @override_settings(CHUNK_MIN_SIZE=1000)
+    @override_settings(CHUNK_MAX_SIZE=1000)
+    @override_settings(CHUNK_CHECKSUM="md5")
+    @override_settings(CHUNK_STORAGE="/tmp")
+    @override_settings(CHUNK_COPY_SIZE=250)
+    def test_complete_upload_parallel(self):
+        attribute = StorageBoxAttribute.objects.create(
+            storage_box=self.dfo.storage_box,
+            key="chunk_assembly_threads",
+            value="2")
+        self.upload_chunk(0)
+        self.upload_chunk(1)
+        response = self.api_client.get(
+            "/api/v1/mydata_upload/%s/complete/" % self.dfo.id,
+            authentication=self.get_credentials())
+        attribute.delete()
+        self.assertEqual(response.status_code, 200)
+        dfo = DataFileObject.objects.get(id=self.dfo.id)
+        self.assertTrue(dfo.verify())
+
+    @override_settings(CHUNK_MIN_SIZE=1000)
+    @override_settings(CHUNK_MAX_SIZE=1000)
+    @override_settings(CHUNK_CHECKSUM="md5")
+    @override_settings(CHUNK_STORAGE="/tmp")
+    @override_settings(CHUNK_COPY_SIZE=250)
+    @override_settings(CHUNK_ASSEMBLY_THREADS=2)
+    def test_complete_upload_parallel_retry(self):
+        self.upload_chunk(0)
+        self.upload_chunk(1)
+        # Full size file with the first chunk missing,
+        # as left by failed parallel assembly
+        dst_path = self.dfo.get_full_path()
+        os.makedirs(os.path.dirname(dst_path))
+        with open(dst_path, "wb") as dst:
+            dst.write(b"\0" * 1000)
+            with open(os.path.join(
+                    self.fixtures_path, self.chunks[1]["name"]), "rb") as src:
+                dst.write(src.read())
+        with mock.patch.object(tasks.dfo_verify, "apply_async"):
+            self.assertTrue(complete_chunked_upload(self.dfo.id))
+        dfo = DataFileObject.objects.get(id=self.dfo.id)
+        self.assertTrue(dfo.verify())
+
+    @override_settings(CHUNK_MIN_SIZE=1000)
+    @override_settings(CHUNK_MAX_SIZE=1000)
+    @override_settings(CHUNK_CHECKSUM="md5")
+    @override_settings(CHUNK_STORAGE="/tmp")
+    @override_settings(CHUNK_COPY_SIZE=250)
+    @override_settings(CHUNK_DIRECT_PLACEMENT=True)
+    def test_complete_upload_direct_placement(self):
+        chunks_folder = os.path.join("/tmp", str(self.dfo.id))
+        # Upload out of order to check chunks are put at their offsets
+        self.upload_chunk(1)
+        self.upload_chunk(0)
+        # Chunks are written straight into data file, not staged
+        self.assertFalse(os.path.exists(chunks_folder))
+        self.assertEqual(
+            Chunk.objects.filter(dfo_id=self.dfo.id, placed=True).count(), 2)
+        self.assertEqual(os.stat(self.dfo.get_full_path()).st_size, 1553)
+        response = self.api_client.get(
+            "/api/v1/mydata_upload/%s/complete/" % self.dfo.id,
+            authentication=self.get_credentials())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Chunk.objects.filter(dfo_id=self.dfo.id).count(), 0)
+        dfo = DataFileObject.objects.get(id=self.dfo.id)
+        self.assertTrue(dfo.verify())
+
+    @override_settings(CHUNK_MIN_SIZE=1000)
+    @override_settings(CHUNK_MAX_SIZE=1000)
+    @override_settings(CHUNK_CHECKSUM="md5")
+    @override_settings(CHUNK_STORAGE="/tmp")
+    @override_settings(CHUNK_DIRECT_PLACEMENT=True)
+    def test_upload_chunk_direct_placement_mismatch(self):
+        md5sum = self.chunks[0]["md5sum"]
+        self.chunks[0]["md5sum"] = self.chunks[1]["md5sum"]
+        response = self.upload_chunk(0)
+        data = json.loads(response.content)
+        self.assertFalse(data["success"])
+        # Range written with unverified chunk is left uncovered
+        self.assertEqual(Chunk.objects.filter(dfo_id=self.dfo.id).count(), 0)
+        session = UploadSession.objects.get(dfo_id=self.dfo.id)
+        self.assertFalse(session.has_chunk(0))
+        # Chunk being written can't be uploaded in parallel
+        cache.add("mydata_chunk_placement_%s_0" % self.dfo.id, True)
+        self.chunks[0]["md5sum"] = md5sum
+        data = json.loads(self.upload_chunk(0).content)
+        self.assertFalse(data["success"])
+        self.assertEqual(data["error"], "Chunk upload in progress.")
+        cache.delete("mydata_chunk_placement_%s_0" % self.dfo.id)
+        # Retry overwrites the range
+        self.assertTrue(json.loads(self.upload_chunk(0).content)["success"])
+        self.assertTrue(json.loads(self.upload_chunk(1).content)["success"])
+        with mock.patch.object(tasks.dfo_verify, "apply_async"):
+            self.assertTrue(complete_chunked_upload(self.dfo.id))
+        dfo = DataFileObject.objects.get(id=self.dfo.id)
+        self.assertTrue(dfo.verify())
+
     @override_settings(CHUNK_MIN_SIZE=1000)
     @override_settings(CHUNK_MAX_SIZE=1000)
     @override_settings(CHUNK_CHECKSUM="md5")
@@ -214,3 +496,566 @@ class UploadAppResourceTest(MyTardisResourceTestCase):
         self.assertFalse(os.path.exists(chunks_folder))
         dfo = DataFileObject.objects.get(id=self.dfo.id)
         self.assertTrue(dfo.verified)
+
+    @override_settings(CHUNK_MIN_SIZE=1000)
+    @override_settings(CHUNK_MAX_SIZE=1000)
+    @override_settings(CHUNK_CHECKSUM="md5")
+    @override_settings(CHUNK_STORAGE="/tmp")
+    def test_complete_task_watermark(self):
+        self.upload_chunk(0)
+        self.upload_chunk(1)
+        with mock.patch.object(complete_chunked_upload, "apply_async") as task:
+            chunks_complete.apply_async()
+            task.assert_called_once_with(args=[self.dfo.id])
+        cache.delete(COMPLETE_TASK_KEY % self.dfo.id)
+        UploadSession.objects.filter(dfo_id=self.dfo.id).update(
+            updated=timezone.now() - timedelta(hours=2))
+        with mock.patch.object(complete_chunked_upload, "apply_async") as task:
+            # Upload session wasn't updated since the previous run
+            chunks_complete.apply_async()
+            task.assert_not_called()
+        cache.delete(FULL_SWEEP_KEY)
+        with mock.patch.object(complete_chunked_upload, "apply_async") as task:
+            # Every upload is checked by periodic full sweep
+            chunks_complete.apply_async()
+            task.assert_called_once_with(args=[self.dfo.id])
+
+    @override_settings(CHUNK_MIN_SIZE=1000)
+    @override_settings(CHUNK_MAX_SIZE=1000)
+    @override_settings(CHUNK_CHECKSUM="md5")
+    @override_settings(CHUNK_STORAGE="/tmp")
+    def test_complete_task_legacy(self):
+        self.upload_chunk(0)
+        self.upload_chunk(1)
+        # Upload started before sessions existed
+        UploadSession.objects.filter(dfo_id=self.dfo.id).delete()
+        cache.delete(FULL_SWEEP_KEY)
+        with mock.patch.object(complete_chunked_upload, "apply_async") as task:
+            chunks_complete.apply_async()
+            task.assert_called_once_with(args=[self.dfo.id])
+        session = UploadSession.objects.get(dfo_id=self.dfo.id)
+        self.assertEqual(session.chunk_size, 1000)
+        self.assertTrue(session.is_complete())
+
+    @override_settings(CHUNK_MIN_SIZE=1000)
+    @override_settings(CHUNK_MAX_SIZE=1000)
+    @override_settings(CHUNK_CHECKSUM="md5")
+    @override_settings(CHUNK_STORAGE="/tmp")
+    @override_settings(CHUNK_VERIFY_INLINE=False)
+    def test_complete_task_verification_failed(self):
+        self.upload_chunk(0)
+        self.upload_chunk(1)
+        with mock.patch.object(tasks.dfo_verify, "apply_async") as task:
+            self.assertTrue(complete_chunked_upload(self.dfo.id))
+            task.assert_called_once()
+        url = "/api/v1/mydata_upload/%s/" % self.dfo.id
+        data = json.loads(self.api_client.get(
+            url, authentication=self.get_credentials()).content)
+        # Waiting for verification
+        self.assertFalse(data["completed"])
+        self.assertEqual(data["missing"], [])
+        self.assertEqual(data["state"], UploadSession.VERIFYING)
+        # Verification didn't succeed within assembly timeout
+        UploadSession.objects.filter(dfo_id=self.dfo.id).update(
+            updated=timezone.now() - timedelta(hours=2))
+        data = json.loads(self.api_client.get(
+            url, authentication=self.get_credentials()).content)
+        self.assertFalse(data["completed"])
+        self.assertEqual(data["offset"], 0)
+        cache.delete(FULL_SWEEP_KEY)
+        chunks_complete.apply_async()
+        self.assertFalse(
+            UploadSession.objects.filter(dfo_id=self.dfo.id).exists())
+        self.assertFalse(os.path.exists(self.dfo.get_full_path()))
+        # Upload starts over
+        self.assertTrue(json.loads(self.upload_chunk(0).content)["success"])
+        self.assertTrue(json.loads(self.upload_chunk(1).content)["success"])
+
+    @override_settings(CHUNK_MIN_SIZE=1000)
+    @override_settings(CHUNK_MAX_SIZE=1000)
+    @override_settings(CHUNK_CHECKSUM="md5")
+    @override_settings(CHUNK_STORAGE="/tmp")
+    def test_complete_task_deduplication(self):
+        self.upload_chunk(0)
+        self.upload_chunk(1)
+        with mock.patch.object(complete_chunked_upload, "apply_async") as task:
+            self.assertTrue(schedule_complete_upload(self.dfo.id))
+            self.assertFalse(schedule_complete_upload(self.dfo.id))
+            task.assert_called_once_with(args=[self.dfo.id])
+        self.assertTrue(complete_chunked_upload(self.dfo.id))
+        session = UploadSession.objects.get(dfo_id=self.dfo.id)
+        self.assertEqual(session.state, UploadSession.VERIFYING)
+        # Duplicate task doesn't redo assembly
+        self.assertFalse(complete_chunked_upload(self.dfo.id))
+
+    @override_settings(CHUNK_MIN_SIZE=1000)
+    @override_settings(CHUNK_MAX_SIZE=1000)
+    @override_settings(CHUNK_CHECKSUM="md5")
+    @override_settings(CHUNK_STORAGE="/tmp")
+    @override_settings(CHUNK_VERIFY_INLINE=True)
+    def test_complete_task_verify_inline(self):
+        self.upload_chunk(0)
+        self.upload_chunk(1)
+        with mock.patch.object(tasks.dfo_verify, "apply_async") as task:
+            self.assertTrue(complete_chunked_upload(self.dfo.id))
+            task.assert_not_called()
+        dfo = DataFileObject.objects.get(id=self.dfo.id)
+        self.assertTrue(dfo.verified)
+        session = UploadSession.objects.get(dfo_id=self.dfo.id)
+        self.assertEqual(session.state, UploadSession.DONE)
+        # Finished sessions are removed
+        chunks_cleanup.apply_async()
+        self.assertFalse(
+            UploadSession.objects.filter(dfo_id=self.dfo.id).exists())
+
+    @override_settings(CHUNK_MIN_SIZE=1000)
+    @override_settings(CHUNK_MAX_SIZE=1000)
+    @override_settings(CHUNK_CHECKSUM="md5")
+    @override_settings(CHUNK_STORAGE="/tmp")
+    @override_settings(CHUNK_VERIFY_INLINE=True)
+    @override_settings(CHUNK_ASSEMBLY_THREADS=2)
+    def test_complete_task_verify_inline_threads(self):
+        self.upload_chunk(0)
+        self.upload_chunk(1)
+        with mock.patch.object(tasks.dfo_verify, "apply_async") as task:
+            self.assertTrue(complete_chunked_upload(self.dfo.id))
+            task.assert_not_called()
+        dfo = DataFileObject.objects.get(id=self.dfo.id)
+        self.assertTrue(dfo.verified)
+
+    @override_settings(CHUNK_MIN_SIZE=1000)
+    @override_settings(CHUNK_MAX_SIZE=1000)
+    @override_settings(CHUNK_CHECKSUM="md5")
+    @override_settings(CHUNK_STORAGE="/tmp")
+    @override_settings(CHUNK_VERIFY_INLINE=True)
+    def test_complete_task_verify_inline_mismatch(self):
+        self.df.md5sum = self.chunks[0]["md5sum"]
+        self.df.save()
+        self.upload_chunk(0)
+        self.upload_chunk(1)
+        self.assertFalse(complete_chunked_upload(self.dfo.id))
+        dfo = DataFileObject.objects.get(id=self.dfo.id)
+        self.assertFalse(dfo.verified)
+        self.assertFalse(os.path.exists(dfo.get_full_path()))
+        self.assertFalse(
+            UploadSession.objects.filter(dfo_id=self.dfo.id).exists())
+
+    @override_settings(CHUNK_MIN_SIZE=1000)
+    @override_settings(CHUNK_MAX_SIZE=1000)
+    @override_settings(CHUNK_CHECKSUM="md5")
+    @override_settings(CHUNK_STORAGE="/tmp")
+    @override_settings(CHUNK_DEDUP=True)
+    def test_link_chunk(self):
+        self.upload_chunk(0)
+        self.upload_chunk(1)
+        df = DataFile(
+            dataset=self.dataset,
+            filename="passenger-copy.txt",
+            md5sum=self.df.md5sum,
+            size=self.df.size)
+        df.save()
+        dfo = DataFileObject(
+            datafile=df,
+            storage_box=StorageBox.get_default_storage())
+        dfo.create_set_uri()
+        dfo.save()
+        for chunk in self.chunks:
+            fname = os.path.join(self.fixtures_path, chunk["name"])
+            with open(fname, "rb") as f:
+                checksum = hashlib.sha256(f.read()).hexdigest()
+            response = self.client.post(
+                "/api/v1/mydata_upload/%s/link/" % dfo.id,
+                **{"Checksum": checksum, "Content-Range": chunk["range"]})
+            data = json.loads(response.content)
+            self.assertTrue(data["success"])
+        response = self.client.post(
+            "/api/v1/mydata_upload/%s/link/" % dfo.id,
+            **{"Checksum": "0" * 64, "Content-Range": "0-1000/1553"})
+        data = json.loads(response.content)
+        self.assertEqual(data["error"], "Chunk already uploaded.")
+        self.assertEqual(ChunkContent.objects.filter(refs=2).count(), 2)
+        paths = [content.get_path() for content in ChunkContent.objects.all()]
+        for path in paths:
+            self.assertTrue(os.path.exists(path))
+        complete_chunked_upload(dfo.id)
+        self.assertTrue(DataFileObject.objects.get(id=dfo.id).verified)
+        self.assertEqual(ChunkContent.objects.filter(refs=1).count(), 2)
+        complete_chunked_upload(self.dfo.id)
+        self.assertTrue(DataFileObject.objects.get(id=self.dfo.id).verified)
+        self.assertFalse(ChunkContent.objects.exists())
+        for path in paths:
+            self.assertFalse(os.path.exists(path))
+        dfo.delete()
+        df.delete()
+
+    @override_settings(CHUNK_MIN_SIZE=1000)
+    @override_settings(CHUNK_MAX_SIZE=1000)
+    @override_settings(CHUNK_CHECKSUM="md5")
+    @override_settings(CHUNK_STORAGE="/tmp")
+    @override_settings(CHUNK_DEDUP=True)
+    def test_upload_chunk_dedup_insert_failed(self):
+        fname = os.path.join(self.fixtures_path, self.chunks[0]["name"])
+        with open(fname, "rb") as f:
+            content_path = ChunkContent.get_content_path(
+                hashlib.sha256(f.read()).hexdigest())
+        with mock.patch.object(
+                Chunk.objects, "create", side_effect=IntegrityError):
+            data = json.loads(self.upload_chunk(0).content)
+        self.assertEqual(data["error"], "Chunk already uploaded.")
+        # Content file isn't stored without its row
+        self.assertFalse(ChunkContent.objects.exists())
+        self.assertFalse(os.path.exists(content_path))
+        self.assertEqual(
+            os.listdir(os.path.join("/tmp", str(self.dfo.id))), [])
+        self.assertTrue(json.loads(self.upload_chunk(0).content)["success"])
+        self.assertTrue(os.path.exists(content_path))
+
+    @override_settings(CHUNK_MIN_SIZE=1000)
+    @override_settings(CHUNK_MAX_SIZE=1000)
+    @override_settings(CHUNK_CHECKSUM="md5")
+    @override_settings(CHUNK_STORAGE="/tmp")
+    @override_settings(CHUNK_STREAM_SIZE=100)
+    def test_upload_chunk_gzip(self):
+        chunk = self.chunks[0]
+        with open(os.path.join(self.fixtures_path, chunk["name"]), "rb") as f:
+            data = gzip.compress(f.read())
+        response = self.client.post(
+            "/api/v1/mydata_upload/%s/upload/" % self.dfo.id,
+            content_type="application/octet-stream",
+            data=data,
+            HTTP_CONTENT_ENCODING="gzip",
+            **{"Checksum": chunk["md5sum"], "Content-Range": chunk["range"]})
+        data = json.loads(response.content)
+        self.assertTrue(data["success"])
+        chunk = Chunk.objects.get(dfo_id=self.dfo.id)
+        self.assertEqual(os.path.getsize(chunk.get_path()), 1000)
+        response = self.client.post(
+            "/api/v1/mydata_upload/%s/upload/" % self.dfo.id,
+            content_type="application/octet-stream",
+            data=b"data",
+            HTTP_CONTENT_ENCODING="br",
+            **{"Checksum": "0",
+               "Content-Range": "1000-1553/1553"})
+        data = json.loads(response.content)
+        self.assertEqual(data["error"], "Unsupported content encoding br.")
+
+    @override_settings(CHUNK_MIN_SIZE=1000)
+    @override_settings(CHUNK_MAX_SIZE=1000)
+    @override_settings(CHUNK_CHECKSUM="md5")
+    @override_settings(CHUNK_STORAGE_ROOTS=["/tmp/mydata-a", "/tmp/mydata-b"])
+    @override_settings(CHUNK_STORAGE_POLICY="round_robin")
+    def test_complete_upload_staging_roots(self):
+        self.upload_chunk(0)
+        self.upload_chunk(1)
+        # Upload is staged on the root its space is reserved on
+        roots = set(Chunk.objects.filter(
+            dfo_id=self.dfo.id).values_list("root", flat=True))
+        self.assertEqual(
+            roots, {UploadSession.objects.get(dfo_id=self.dfo.id).root})
+        self.assertTrue(roots < {"/tmp/mydata-a", "/tmp/mydata-b"})
+        complete_chunked_upload(self.dfo.id)
+        dfo = DataFileObject.objects.get(id=self.dfo.id)
+        self.assertTrue(dfo.verified)
+        for root in roots:
+            self.assertFalse(
+                os.path.exists(os.path.join(root, str(self.dfo.id))))
+
+    @override_settings(CHUNK_MIN_SIZE=1000)
+    @override_settings(CHUNK_MAX_SIZE=1000)
+    @override_settings(CHUNK_CHECKSUM="md5")
+    @override_settings(CHUNK_STORAGE_ROOTS=["/tmp/mydata-a", "/tmp/mydata-b"])
+    @override_settings(CHUNK_STORAGE_POLICY="fastest")
+    def test_upload_chunk_unknown_policy(self):
+        data = json.loads(self.upload_chunk(0).content)
+        self.assertFalse(data["success"])
+        self.assertIn("Unknown CHUNK_STORAGE_POLICY fastest", data["error"])
+
+    @override_settings(CHUNK_MIN_SIZE=1000)
+    @override_settings(CHUNK_MAX_SIZE=1000)
+    @override_settings(CHUNK_CHECKSUM="md5")
+    @mock.patch.object(chunkstore, "MIN_PART_SIZE", 1000)
+    def test_complete_upload_object_staging(self):
+        client = FakeS3Client()
+        store = chunkstore.ObjectChunkStore(client, "bucket", "passenger.txt")
+        with mock.patch.object(
+                chunkstore, "get_object_store", return_value=store):
+            self.upload_chunk(1)
+            self.upload_chunk(0)
+            self.assertEqual(len(client.uploads), 1)
+            self.assertFalse(os.path.exists(
+                os.path.join(settings.CHUNK_STORAGE, str(self.dfo.id))))
+            with mock.patch.object(tasks.dfo_verify, "apply_async") as task:
+                self.assertTrue(complete_chunked_upload(self.dfo.id))
+                task.assert_called_once()
+        data = b""
+        for chunk in self.chunks:
+            fname = os.path.join(self.fixtures_path, chunk["name"])
+            with open(fname, "rb") as f:
+                data += f.read()
+        self.assertEqual(client.objects[("bucket", "passenger.txt")], data)
+        session = UploadSession.objects.get(dfo_id=self.dfo.id)
+        self.assertEqual(session.state, UploadSession.VERIFYING)
+        self.assertEqual(session.multipart_id, "")
+
+    @override_settings(CHUNK_MIN_SIZE=1000)
+    @override_settings(CHUNK_MAX_SIZE=1000)
+    @override_settings(CHUNK_CHECKSUM="md5")
+    @mock.patch.object(chunkstore, "MIN_PART_SIZE", 1000)
+    def test_cleanup_object_staging(self):
+        client = FakeS3Client()
+        store = chunkstore.ObjectChunkStore(
+            client, "bucket", "passenger.txt", self.dfo.storage_box.id)
+        with mock.patch.object(
+                chunkstore, "get_object_store", return_value=store):
+            self.upload_chunk(0)
+        session = UploadSession.objects.get(dfo_id=self.dfo.id)
+        self.assertEqual(session.multipart_bucket, "bucket")
+        self.assertEqual(session.multipart_key, "passenger.txt")
+        self.assertEqual(len(client.uploads), 1)
+        self.dfo.delete()
+        self.df.delete()
+        # Upload is aborted without the removed DataFileObject
+        storage = mock.Mock(bucket_name="bucket")
+        storage.connection.meta.client = client
+        with mock.patch.object(
+                chunkstore, "get_object_storage", return_value=storage):
+            chunks_cleanup.apply_async()
+        self.assertEqual(client.uploads, {})
+        self.assertFalse(
+            UploadSession.objects.filter(dfo_id=session.dfo_id).exists())
+
+    @override_settings(CHUNK_MIN_SIZE=1000)
+    @override_settings(CHUNK_MAX_SIZE=1000)
+    @override_settings(CHUNK_CHECKSUM="md5")
+    @mock.patch.object(chunkstore, "MIN_PART_SIZE", 1000)
+    def test_complete_upload_object_staging_reclaimed(self):
+        client = FakeS3Client()
+        store = chunkstore.ObjectChunkStore(client, "bucket", "passenger.txt")
+        with mock.patch.object(
+                chunkstore, "get_object_store", return_value=store):
+            self.upload_chunk(0)
+            self.upload_chunk(1)
+            session = UploadSession.objects.get(dfo_id=self.dfo.id)
+            parts = [(session.chunk_index(chunk.offset) + 1, chunk.etag)
+                     for chunk in Chunk.objects.filter(dfo_id=self.dfo.id)]
+            # Task composed the object and was lost before recording it
+            store.compose(session.multipart_id, parts)
+            UploadSession.objects.filter(pk=session.pk).update(
+                state=UploadSession.VERIFYING,
+                updated=timezone.now() - timedelta(hours=2))
+            with mock.patch.object(tasks.dfo_verify, "apply_async") as task:
+                self.assertTrue(complete_chunked_upload(self.dfo.id))
+                task.assert_called_once()
+        self.assertEqual(
+            UploadSession.objects.get(dfo_id=self.dfo.id).state,
+            UploadSession.VERIFYING)
+
+    @override_settings(CHUNK_MIN_SIZE=1000)
+    @override_settings(CHUNK_MAX_SIZE=1000)
+    @override_settings(CHUNK_CHECKSUM="md5")
+    def test_upload_chunk_object_staging_part_size(self):
+        store = chunkstore.ObjectChunkStore(
+            FakeS3Client(), "bucket", "passenger.txt")
+        with mock.patch.object(
+                chunkstore, "get_object_store", return_value=store):
+            data = json.loads(self.upload_chunk(0).content)
+        self.assertFalse(data["success"])
+        self.assertIn("below minimum part size", data["error"])
+
+    @override_settings(CHUNK_MIN_SIZE=1000)
+    @override_settings(CHUNK_MAX_SIZE=1000)
+    @override_settings(CHUNK_CHECKSUM="md5")
+    @override_settings(CHUNK_STORAGE="/tmp")
+    @override_settings(CHUNK_RESERVE_MARGIN=0)
+    @override_settings(CHUNK_RETRY_AFTER=30)
+    def test_upload_chunk_no_space(self):
+        with mock.patch.object(staging.shutil, "disk_usage",
+                               return_value=mock.Mock(free=1000)):
+            response = self.upload_chunk(0)
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response["Retry-After"], "30")
+        data = json.loads(response.content)
+        self.assertEqual(
+            data["error"], "Not enough space to stage the upload.")
+        self.assertFalse(Chunk.objects.filter(dfo_id=self.dfo.id).exists())
+        with mock.patch.object(staging.shutil, "disk_usage",
+                               return_value=mock.Mock(free=2000)):
+            response = self.upload_chunk(0)
+        data = json.loads(response.content)
+        self.assertTrue(data["success"])
+        session = UploadSession.objects.get(dfo_id=self.dfo.id)
+        self.assertEqual(session.reserved, 1553)
+        self.assertEqual(session.root, "/tmp")
+        self.assertEqual(staging.get_reserved_space("/tmp"), 553)
+        self.assertEqual(staging.get_reserved_space("/tmp/mydata-a"), 0)
+
+    @override_settings(CHUNK_MIN_SIZE=1000)
+    @override_settings(CHUNK_MAX_SIZE=1000)
+    @override_settings(CHUNK_CHECKSUM="md5")
+    @override_settings(CHUNK_STORAGE="/tmp")
+    @override_settings(CHUNK_MAX_CONCURRENT_PER_USER=1)
+    @override_settings(CHUNK_RETRY_AFTER=30)
+    def test_upload_chunk_throttled(self):
+        cache.clear()
+        busy = throttling.UploadThrottle(None, self.user.id)
+        self.assertIsNone(busy.acquire(1000))
+        response = self.upload_chunk(0)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response["Retry-After"], "30")
+        busy.release()
+        data = json.loads(self.upload_chunk(0).content)
+        self.assertTrue(data["success"])
+
+    @override_settings(CHUNK_MIN_SIZE=1000)
+    @override_settings(CHUNK_MAX_SIZE=1000)
+    @override_settings(CHUNK_CHECKSUM="md5")
+    @override_settings(CHUNK_STORAGE="/tmp")
+    def test_upload_chunk_token(self):
+        response = self.api_client.get(
+            "/api/v1/mydata_upload/%s/" % self.dfo.id,
+            authentication=self.get_credentials())
+        token = json.loads(response.content)["token"]
+        client = Client()
+        chunk = self.chunks[0]
+        fname = os.path.join(self.fixtures_path, chunk["name"])
+        with open(fname, "rb") as f:
+            body = f.read()
+        headers = {
+            "Checksum": chunk["md5sum"],
+            "Content-Range": chunk["range"],
+            "Upload-Token": token
+        }
+        response = client.post(
+            "/api/v1/mydata_upload/%s/upload/" % (self.dfo.id + 1),
+            content_type="application/octet-stream", data=body, **headers)
+        data = json.loads(response.content)
+        self.assertEqual(data["error"], "Invalid or expired upload token.")
+        response = client.post(
+            "/api/v1/mydata_upload/%s/upload/" % self.dfo.id,
+            content_type="application/octet-stream", data=body, **headers)
+        data = json.loads(response.content)
+        self.assertTrue(data["success"])
+        self.assertEqual(
+            Chunk.objects.get(dfo_id=self.dfo.id).user_id, self.user.id)
+        with override_settings(CHUNK_TOKEN_MAX_AGE=-1):
+            headers["Content-Range"] = "1000-1553/1553"
+            response = client.post(
+                "/api/v1/mydata_upload/%s/upload/" % self.dfo.id,
+                content_type="application/octet-stream", data=b"", **headers)
+        data = json.loads(response.content)
+        self.assertEqual(data["error"], "Invalid or expired upload token.")
+        # Token outlives the object
+        headers["Content-Range"] = "1000-1553/1553"
+        dfo_id = self.dfo.id
+        self.dfo.delete()
+        response = client.post(
+            "/api/v1/mydata_upload/%s/upload/" % dfo_id,
+            content_type="application/octet-stream", data=b"", **headers)
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content)
+        self.assertEqual(data["error"], "Invalid object or access denied.")
+
+    def count_statements(self, queries):
+        """
+        Count queries other than transaction control,
+        which differs between databases
+        """
+        return len([
+            query for query in queries.captured_queries
+            if not query["sql"].startswith(
+                ("BEGIN", "SAVEPOINT", "RELEASE SAVEPOINT"))])
+
+    @override_settings(CHUNK_MIN_SIZE=500)
+    @override_settings(CHUNK_MAX_SIZE=500)
+    @override_settings(CHUNK_CHECKSUM="md5")
+    @override_settings(CHUNK_STORAGE="/tmp")
+    def test_upload_chunk_queries(self):
+        data = b""
+        for chunk in self.chunks:
+            fname = os.path.join(self.fixtures_path, chunk["name"])
+            with open(fname, "rb") as f:
+                data += f.read()
+        self.chunks = [{
+            "name": None,
+            "range": "%s-%s/1553" % (offset, offset + 500),
+            "body": data[offset:offset+500],
+            "md5sum": hashlib.md5(data[offset:offset+500]).hexdigest()
+        } for offset in range(0, 1500, 500)]
+        # Caches permission decision of the user for the object
+        response = self.client.get("/api/v1/mydata_upload/%s/" % self.dfo.id)
+        token = json.loads(response.content)["token"]
+
+        def post(client, pos, **headers):
+            chunk = self.chunks[pos]
+            return client.post(
+                "/api/v1/mydata_upload/%s/upload/" % self.dfo.id,
+                content_type="application/octet-stream",
+                data=chunk["body"],
+                Checksum=chunk["md5sum"],
+                **{"Content-Range": chunk["range"]},
+                **headers)
+
+        # First chunk starts the session and reserves staging space
+        response = post(Client(), 0, **{"Upload-Token": token})
+        self.assertTrue(json.loads(response.content)["success"])
+        with CaptureQueriesContext(connection) as queries:
+            response = post(Client(), 1, **{"Upload-Token": token})
+        self.assertTrue(json.loads(response.content)["success"])
+        # DataFileObject, session, chunk insert, locked session and
+        # its update
+        self.assertEqual(self.count_statements(queries), 5)
+        with CaptureQueriesContext(connection) as queries:
+            response = post(self.client, 2)
+        self.assertTrue(json.loads(response.content)["success"])
+        # Login session and user on top of the token path
+        self.assertEqual(self.count_statements(queries), 7)
+
+
+class FakeS3Client:
+    """
+    Multipart upload calls of S3 client, keeping objects in memory
+    """
+
+    def __init__(self):
+        self.uploads = {}
+        self.objects = {}
+
+    def create_multipart_upload(self, Bucket, Key):
+        upload_id = str(len(self.uploads) + 1)
+        self.uploads[upload_id] = {}
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, ContentLength,
+                    Body):
+        data = Body.read()
+        assert len(data) == ContentLength
+        self.uploads[UploadId][PartNumber] = data
+        return {"ETag": '"%s"' % hashlib.md5(data).hexdigest()}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId,
+                                  MultipartUpload):
+        if UploadId not in self.uploads:
+            raise FakeS3Error("NoSuchUpload")
+        parts = self.uploads.pop(UploadId)
+        self.objects[(Bucket, Key)] = b"".join(
+            parts[part["PartNumber"]] for part in MultipartUpload["Parts"]
+            if part["ETag"] == '"%s"' % hashlib.md5(
+                parts[part["PartNumber"]]).hexdigest())
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.uploads.pop(UploadId, None)
+
+    def head_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise FakeS3Error("404")
+        return {"ContentLength": len(self.objects[(Bucket, Key)])}
+
+
+class FakeS3Error(Exception):
+    """
+    S3 client error with error code in the response
+    """
+
+    def __init__(self, code):
+        super().__init__(code)
+        self.response = {"Error": {"Code": code}}
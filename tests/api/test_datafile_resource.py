@@ -4,19 +4,29 @@ Testing the DataFile resource in MyTardis's Tastypie-based REST API
 .. moduleauthor:: Grischa Meyer <grischa@gmail.com>
 .. moduleauthor:: James Wettenhall <james.wettenhall@monash.edu>
 '''
+import hashlib
 import json
 import tempfile
+from datetime import datetime
 
 from unittest.mock import patch
 
+from django.contrib.auth.models import Permission, User
+from django.db.models.signals import post_save
 from django.db.utils import DatabaseError
+from django.test import override_settings
 from django.test.client import Client
 
 from tardis.tardis_portal.models.datafile import DataFile, DataFileObject
 from tardis.tardis_portal.models.dataset import Dataset
 from tardis.tardis_portal.models.parameters import ParameterName
 from tardis.tardis_portal.models.parameters import Schema
+from tardis.tardis_portal.models.storage import StorageBox
 
+from ...api.datafile import DataFileAppResource, storage_boxes
+from ...models.uploader import Uploader, UploaderRegistrationRequest
+from ...uploadhandler import ChecksumUploadHandler
+from ... import utils
 from . import MyTardisResourceTestCase
 
 
@@ -205,3 +215,304 @@ class DataFileResourceTest(MyTardisResourceTestCase):
             content_type='application/json')
         self.assertHttpConflict(response)
         df.delete()
+
+    def test_diff_manifest(self):
+        unverified = DataFile(dataset=self.testds, filename="unverified.txt",
+                              size=8, md5sum="bogus")
+        unverified.save()
+        dfo = DataFileObject(datafile=unverified,
+                             storage_box=StorageBox.get_default_storage())
+        dfo.create_set_uri()
+        dfo.save()
+        manifest = "\n".join(json.dumps(entry) for entry in [
+            {"directory": "", "filename": "testfile.txt", "size": 42},
+            {"directory": "", "filename": "new.txt", "size": 8},
+            {"directory": "", "filename": "unverified.txt", "size": 8,
+             "md5sum": "bogus"},
+            {"directory": "", "filename": "testfile.txt", "size": 43}
+        ])
+        response = self.django_client.post(
+            '/api/v1/mydata_dataset_file/manifest/%s/' % self.testds.id,
+            manifest,
+            content_type='application/x-ndjson')
+        self.assertHttpOK(response)
+        results = [json.loads(line) for line in
+                   response.content.decode().splitlines()]
+        self.assertEqual(results, [
+            {"directory": "", "filename": "testfile.txt",
+             "status": "unverified", "id": self.datafile.id},
+            {"directory": "", "filename": "new.txt", "status": "new"},
+            {"directory": "", "filename": "unverified.txt",
+             "status": "unverified", "id": unverified.id, "dfo_id": dfo.id},
+            {"directory": "", "filename": "testfile.txt", "status": "changed",
+             "id": self.datafile.id}
+        ])
+        manifest += "\n" + json.dumps({"filename": "missing_size.txt"})
+        response = self.django_client.post(
+            '/api/v1/mydata_dataset_file/manifest/%s/' % self.testds.id,
+            manifest,
+            content_type='application/x-ndjson')
+        self.assertHttpBadRequest(response)
+        self.assertEqual(json.loads(response.content)["line"], 5)
+
+    def test_diff_manifest_naive_times(self):
+        with override_settings(USE_TZ=False):
+            self.datafile.modification_time = datetime(2020, 1, 1, 12)
+            self.datafile.save()
+            manifest = json.dumps({
+                "directory": "", "filename": "testfile.txt",
+                "size": self.datafile.size, "mtime": "2020-01-01T12:00:00"})
+            response = self.django_client.post(
+                '/api/v1/mydata_dataset_file/manifest/%s/' % self.testds.id,
+                manifest,
+                content_type='application/x-ndjson')
+        self.assertHttpOK(response)
+        result = json.loads(response.content)
+        self.assertEqual(result["status"], "unverified")
+
+    def test_bulk_create(self):
+        empty = DataFile(dataset=self.testds, filename="empty.txt",
+                         size=8, md5sum="bogus")
+        empty.save()
+        post_data = {
+            "dataset": "/api/v1/dataset/%d/" % self.testds.id,
+            "datafiles": [{
+                "filename": "bulk%s.txt" % i,
+                "directory": "bulk",
+                "md5sum": "930e419034038dfad994f0d2e602146c",
+                "size": "8"
+            } for i in range(3)] + [{
+                "filename": "testfile.txt",
+                "md5sum": "930e419034038dfad994f0d2e602146c",
+                "size": "8"
+            }, {
+                "filename": "bulk0.txt",
+                "directory": "bulk",
+                "md5sum": "930e419034038dfad994f0d2e602146c",
+                "size": "8"
+            }, {
+                "filename": "empty.txt",
+                "md5sum": "930e419034038dfad994f0d2e602146c",
+                "size": "8"
+            }, {
+                "filename": "nosize.txt",
+                "md5sum": "930e419034038dfad994f0d2e602146c"
+            }, {
+                "filename": "zerosize.txt",
+                "md5sum": "930e419034038dfad994f0d2e602146c",
+                "size": "0"
+            }]
+        }
+        datafile_count = DataFile.objects.count()
+        saved = []
+
+        def receiver(sender, instance, created, **kwargs):
+            saved.append((sender, instance.pk, created))
+
+        post_save.connect(receiver, sender=DataFile)
+        post_save.connect(receiver, sender=DataFileObject)
+        try:
+            response = self.django_client.post(
+                '/api/v1/mydata_dataset_file/bulk/',
+                json.dumps(post_data),
+                content_type='application/json')
+        finally:
+            post_save.disconnect(receiver, sender=DataFile)
+            post_save.disconnect(receiver, sender=DataFileObject)
+        self.assertHttpOK(response)
+        results = json.loads(response.content)["datafiles"]
+        self.assertEqual(len(results), 8)
+        for result in results[:3] + results[5:6]:
+            self.assertIn((DataFile, result["id"], True), saved)
+            self.assertIn((DataFileObject, result["dfo_id"], True), saved)
+        for result in results[:3] + results[5:6]:
+            dfo = DataFileObject.objects.get(id=result["dfo_id"])
+            self.assertEqual(dfo.datafile.id, result["id"])
+            self.assertEqual(dfo.get_full_path(), result["path"])
+        self.assertEqual(results[3]["status"], 409)
+        self.assertEqual(results[4]["status"], 409)
+        self.assertEqual(results[6]["status"], 400)
+        self.assertEqual(results[7]["status"], 400)
+        self.assertFalse(DataFile.objects.filter(id=empty.id).exists())
+        self.assertEqual(datafile_count + 3, DataFile.objects.count())
+
+    def test_bulk_create_unauthorized(self):
+        other = User.objects.create_user(username="other", password="other")
+        client = Client()
+        client.login(username="other", password="other")
+        post_data = {
+            "dataset": "/api/v1/dataset/%d/" % self.testds.id,
+            "datafiles": [{
+                "filename": "bulk.txt",
+                "md5sum": "930e419034038dfad994f0d2e602146c",
+                "size": "8"
+            }]
+        }
+        # Model permissions are required as for single DataFile
+        self.assertHttpUnauthorized(client.post(
+            '/api/v1/mydata_dataset_file/bulk/',
+            json.dumps(post_data),
+            content_type='application/json'))
+        for perm in ["change_dataset", "add_datafile", "add_datafileobject"]:
+            other.user_permissions.add(Permission.objects.get(codename=perm))
+        self.assertHttpUnauthorized(client.post(
+            '/api/v1/mydata_dataset_file/bulk/',
+            json.dumps(post_data),
+            content_type='application/json'))
+        # Missing dataset isn't told apart from inaccessible one
+        post_data["dataset"] = "/api/v1/dataset/%d/" % (self.testds.id + 1000)
+        self.assertHttpUnauthorized(self.django_client.post(
+            '/api/v1/mydata_dataset_file/bulk/',
+            json.dumps(post_data),
+            content_type='application/json'))
+        self.assertFalse(DataFile.objects.filter(filename="bulk.txt").exists())
+        other.delete()
+
+    def test_storage_box_cache(self):
+        storage_boxes.invalidate()
+        sbox = StorageBox.get_default_storage()
+        post_data = {
+            "dataset": "/api/v1/dataset/%d/" % self.testds.id,
+            "md5sum": "930e419034038dfad994f0d2e602146c",
+            "size": "8",
+            "mimetype": "text/plain",
+            "parameter_sets": []
+        }
+        with patch.object(
+                DataFileAppResource, "_find_approved_storage_box",
+                autospec=True, return_value=sbox.id) as find:
+            for filename in ["cached1.txt", "cached2.txt"]:
+                post_data["filename"] = filename
+                self.assertHttpCreated(self.django_client.post(
+                    '/api/v1/mydata_dataset_file/',
+                    json.dumps(post_data),
+                    content_type='application/json'))
+                self.assertEqual(
+                    DataFile.objects.get(filename=filename)
+                    .file_objects.get().storage_box, sbox)
+            self.assertEqual(find.call_count, 1)
+            self.uploader.save()
+            post_data["filename"] = "cached3.txt"
+            self.assertHttpCreated(self.django_client.post(
+                '/api/v1/mydata_dataset_file/',
+                json.dumps(post_data),
+                content_type='application/json'))
+            self.assertEqual(find.call_count, 2)
+            # Uploaders without approved storage box are kept too
+            storage_boxes.invalidate()
+            find.return_value = False
+            for filename in ["unapproved1.txt", "unapproved2.txt"]:
+                post_data["filename"] = filename
+                self.assertHttpCreated(self.django_client.post(
+                    '/api/v1/mydata_dataset_file/',
+                    json.dumps(post_data),
+                    content_type='application/json'))
+            self.assertEqual(find.call_count, 3)
+
+    def test_find_approved_storage_box(self):
+        resource = DataFileAppResource()
+        key = ('uuid', self.uploader_uuid, self.requester_key_fingerprint)
+        self.assertEqual(
+            resource._find_approved_storage_box(key),
+            self.uploader_request.approved_storage_box_id)
+        self.assertFalse(resource._find_approved_storage_box(
+            ('uuid', 'unknown', self.requester_key_fingerprint)))
+        # Uploader with several keys registered
+        self.uploader.wan_ip_address = "10.0.0.1"
+        self.uploader.save()
+        UploaderRegistrationRequest.objects.create(
+            uploader=self.uploader,
+            requester_key_fingerprint="other")
+        self.assertEqual(
+            resource._find_approved_storage_box(
+                ('ip', "10.0.0.1", self.testinstrument.id)),
+            self.uploader_request.approved_storage_box_id)
+        self.assertFalse(resource._find_approved_storage_box(
+            ('ip', "10.0.0.2", self.testinstrument.id)))
+        with patch.object(Uploader.objects, "filter",
+                          side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                resource._find_approved_storage_box(
+                    ('ip', "10.0.0.1", self.testinstrument.id))
+
+    def test_empty_duplicate_of_other_dataset(self):
+        other = User.objects.create_user(username="other", password="other")
+        for perm in ["add_datafile", "add_datafileobject"]:
+            other.user_permissions.add(Permission.objects.get(codename=perm))
+        client = Client()
+        client.login(username="other", password="other")
+        empty = DataFile.objects.create(
+            dataset=self.testds, filename="empty.txt", size=8, md5sum="bogus")
+        post_data = {
+            "dataset": "/api/v1/dataset/%d/" % self.testds.id,
+            "filename": "empty.txt",
+            "directory": "",
+            "md5sum": "930e419034038dfad994f0d2e602146c",
+            "size": "8",
+            "mimetype": "text/plain",
+            "parameter_sets": []
+        }
+        self.assertHttpUnauthorized(client.post(
+            '/api/v1/mydata_dataset_file/',
+            json.dumps(post_data),
+            content_type='application/json'))
+        self.assertTrue(DataFile.objects.filter(id=empty.id).exists())
+        post_data["filename"] = "testfile.txt"
+        self.assertHttpUnauthorized(client.post(
+            '/api/v1/mydata_dataset_file/',
+            json.dumps(post_data),
+            content_type='application/json'))
+        other.delete()
+
+    def test_post_file_checksums(self):
+        post_data = json.dumps({
+            "dataset": "/api/v1/dataset/%d/" % self.testds.id,
+            "filename": "checksummed.txt",
+            "size": "8",
+            "mimetype": "text/plain",
+            "parameter_sets": []
+        })
+        with tempfile.NamedTemporaryFile() as post_file, \
+                patch.object(utils, "calc_file_checksums",
+                             wraps=utils.calc_file_checksums) as calc:
+            file_content = b"123test\n"
+            post_file.write(file_content)
+            post_file.flush()
+            post_file.seek(0)
+            self.assertHttpCreated(self.django_client.post(
+                '/api/v1/mydata_dataset_file/',
+                data={"json_data": post_data, "attached_file": post_file}))
+        # Hashed while received, file isn't read again
+        calc.assert_not_called()
+        new_file = DataFile.objects.get(filename="checksummed.txt")
+        self.assertEqual(
+            new_file.md5sum, hashlib.md5(file_content).hexdigest())
+        self.assertEqual(
+            new_file.sha512sum, hashlib.sha512(file_content).hexdigest())
+
+    def test_post_file_checksums_fallback(self):
+        post_data = json.dumps({
+            "dataset": "/api/v1/dataset/%d/" % self.testds.id,
+            "filename": "rehashed.txt",
+            "size": "8",
+            "mimetype": "text/plain",
+            "parameter_sets": []
+        })
+        with tempfile.NamedTemporaryFile() as post_file, \
+                patch.object(ChecksumUploadHandler, "file_complete",
+                             return_value=None), \
+                patch.object(utils, "calc_file_checksums",
+                             wraps=utils.calc_file_checksums) as calc:
+            file_content = b"123test\n"
+            post_file.write(file_content)
+            post_file.flush()
+            post_file.seek(0)
+            self.assertHttpCreated(self.django_client.post(
+                '/api/v1/mydata_dataset_file/',
+                data={"json_data": post_data, "attached_file": post_file}))
+        self.assertEqual(calc.call_count, 1)
+        new_file = DataFile.objects.get(filename="rehashed.txt")
+        self.assertEqual(
+            new_file.md5sum, hashlib.md5(file_content).hexdigest())
+        self.assertEqual(
+            new_file.sha512sum, hashlib.sha512(file_content).hexdigest())
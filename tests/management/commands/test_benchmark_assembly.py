@@ -0,0 +1,20 @@
+from io import StringIO
+
+from django.test import SimpleTestCase
+from django.core.management import call_command
+
+
+class BenchmarkAssemblyTestCase(SimpleTestCase):
+
+    def test_benchmark_assembly(self):
+        '''
+        ./manage.py benchmark_assembly
+        reports throughput for every assembly method
+        '''
+        mock_stdout = StringIO()
+        call_command('benchmark_assembly', size=2500, chunk_size=1000,
+                     copy_size=300, threads='1,2', stdout=mock_stdout)
+        output = mock_stdout.getvalue()
+        self.assertIn('buffered:', output)
+        self.assertIn('kernel 1 threads:', output)
+        self.assertIn('kernel 2 threads:', output)
@@ -0,0 +1,28 @@
+from django.test import SimpleTestCase
+
+from ...models.upload import UploadSession
+
+
+class UploadSessionTestCase(SimpleTestCase):
+
+    def test_missing_ranges(self):
+        session = UploadSession(dfo_id=1, size=1553, chunk_size=300)
+        self.assertEqual(session.missing_ranges(), [[0, 1553]])
+        self.assertTrue(session.set_chunk(300, 300))
+        self.assertTrue(session.set_chunk(1500, 53))
+        self.assertFalse(session.set_chunk(300, 300))
+        self.assertEqual(session.received, 353)
+        self.assertEqual(
+            session.missing_ranges(), [[0, 300], [600, 1500]])
+        self.assertFalse(session.is_complete())
+        for offset in [0, 600, 900, 1200]:
+            session.set_chunk(offset, 300)
+        self.assertEqual(session.missing_ranges(), [])
+        self.assertTrue(session.is_complete())
+
+    def test_is_aligned(self):
+        session = UploadSession(dfo_id=1, size=1553, chunk_size=1000)
+        self.assertTrue(session.is_aligned(0, 1000))
+        self.assertTrue(session.is_aligned(1000, 553))
+        self.assertFalse(session.is_aligned(500, 1000))
+        self.assertFalse(session.is_aligned(1000, 500))
@@ -0,0 +1,36 @@
+from unittest import mock
+
+from django.test import SimpleTestCase, override_settings
+
+from .. import chunkstore
+
+
+class ObjectStoreTestCase(SimpleTestCase):
+
+    def get_dfo(self, storage):
+        dfo = mock.Mock(uri="dataset/passenger.txt")
+        dfo.storage_box.get_initialised_storage_instance.return_value = \
+            storage
+        return dfo
+
+    @override_settings(CHUNK_OBJECT_STAGING=True)
+    def test_get_object_store(self):
+        storage = mock.Mock(spec=["bucket_name", "connection", "location"])
+        storage.bucket_name = "bucket"
+        storage.location = "data"
+        store = chunkstore.get_object_store(self.get_dfo(storage))
+        self.assertIs(store.client, storage.connection.meta.client)
+        self.assertEqual(store.bucket, "bucket")
+        self.assertEqual(store.key, "data/dataset/passenger.txt")
+
+    @override_settings(CHUNK_OBJECT_STAGING=True)
+    def test_get_object_store_filesystem(self):
+        storage = mock.Mock(spec=["location", "path"])
+        self.assertIsNone(chunkstore.get_object_store(self.get_dfo(storage)))
+
+    @override_settings(CHUNK_OBJECT_STAGING=False)
+    def test_get_object_store_disabled(self):
+        storage = mock.Mock(spec=["bucket_name", "connection", "location"])
+        dfo = self.get_dfo(storage)
+        self.assertIsNone(chunkstore.get_object_store(dfo))
+        dfo.storage_box.get_initialised_storage_instance.assert_not_called()
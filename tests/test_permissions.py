@@ -0,0 +1,45 @@
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import SimpleTestCase, override_settings
+
+from .. import permissions
+
+
+@override_settings(CACHES={
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+})
+@override_settings(MYDATA_PERMISSION_CACHE_TTL=30)
+class PermissionCacheTestCase(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+        permissions.invalidate()
+
+    def test_cached_permission(self):
+        compute = mock.Mock(return_value=True)
+        request = mock.Mock(spec=[])
+        for _ in range(3):
+            self.assertTrue(
+                permissions.cached_permission(request, ("key", 1), compute))
+        self.assertEqual(compute.call_count, 1)
+        # Shared by requests within the process
+        self.assertTrue(permissions.cached_permission(
+            mock.Mock(spec=[]), ("key", 1), compute))
+        self.assertEqual(compute.call_count, 1)
+        permissions.invalidate()
+        self.assertTrue(permissions.cached_permission(
+            mock.Mock(spec=[]), ("key", 1), compute))
+        self.assertEqual(compute.call_count, 2)
+
+    def test_failed_permission_not_cached(self):
+        compute = mock.Mock(return_value=None)
+        for _ in range(2):
+            self.assertIsNone(permissions.cached_permission(
+                mock.Mock(spec=[]), ("key", 2), compute))
+        self.assertEqual(compute.call_count, 2)
+        compute.return_value = False
+        for _ in range(2):
+            self.assertFalse(permissions.cached_permission(
+                mock.Mock(spec=[]), ("key", 2), compute))
+        self.assertEqual(compute.call_count, 3)
@@ -0,0 +1,33 @@
+import tempfile
+from unittest import mock
+
+from django.core.files.storage import FileSystemStorage, Storage
+from django.test import SimpleTestCase, override_settings
+
+from .. import staging
+
+
+@override_settings(CHUNK_STORAGE_POLICY="same_device")
+class StagingPolicyTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.roots = [tempfile.gettempdir(), "/nonexistent/mydata"]
+
+    def get_dfo(self, storage_class):
+        dfo = mock.Mock()
+        dfo.get_full_path.return_value = tempfile.gettempdir()
+        return dfo, mock.patch.object(
+            staging, "get_storage_class", return_value=storage_class)
+
+    def test_same_device(self):
+        dfo, storage = self.get_dfo(FileSystemStorage)
+        with storage, override_settings(CHUNK_STORAGE_ROOTS=self.roots):
+            self.assertIn(staging.choose_staging_root(dfo), self.roots)
+        dfo.get_full_path.assert_called_once_with()
+
+    def test_same_device_object_storage(self):
+        dfo, storage = self.get_dfo(Storage)
+        dfo.get_full_path.side_effect = NotImplementedError
+        with storage, override_settings(CHUNK_STORAGE_ROOTS=self.roots):
+            self.assertIn(staging.choose_staging_root(dfo), self.roots)
+        dfo.get_full_path.assert_not_called()
@@ -0,0 +1,59 @@
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import SimpleTestCase, override_settings
+
+from .. import throttling
+
+
+@override_settings(CACHES={
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+})
+class UploadThrottleTestCase(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    @override_settings(CHUNK_MAX_CONCURRENT_PER_INSTRUMENT=2)
+    @override_settings(CHUNK_RETRY_AFTER=5)
+    def test_concurrency(self):
+        first = throttling.UploadThrottle(1, 1)
+        second = throttling.UploadThrottle(1, 2)
+        self.assertIsNone(first.acquire(100))
+        self.assertIsNone(second.acquire(100))
+        self.assertEqual(throttling.UploadThrottle(1, 3).acquire(100), 5)
+        # Other instruments are not affected
+        self.assertIsNone(throttling.UploadThrottle(2, 3).acquire(100))
+        first.release()
+        self.assertIsNone(throttling.UploadThrottle(1, 3).acquire(100))
+
+    @override_settings(CHUNK_MAX_CONCURRENT_PER_INSTRUMENT=2)
+    @override_settings(CHUNK_THROTTLE_TIMEOUT=10)
+    def test_concurrency_counter_refreshed(self):
+        key = throttling.ACTIVE_KEY % ("instrument", 1)
+        first = throttling.UploadThrottle(1, 1)
+        second = throttling.UploadThrottle(1, 2)
+        with mock.patch("time.time", return_value=1000):
+            self.assertIsNone(first.acquire(100))
+        with mock.patch("time.time", return_value=1008):
+            self.assertIsNone(second.acquire(100))
+        # Counter is kept since the last slot was taken
+        with mock.patch("time.time", return_value=1015):
+            first.release()
+            self.assertEqual(cache.get(key), 1)
+
+    @override_settings(CHUNK_MAX_RATE_PER_USER=100)
+    @override_settings(CHUNK_RATE_WINDOW=10)
+    def test_rate(self):
+        with mock.patch.object(throttling.time, "time", return_value=1002):
+            self.assertIsNone(throttling.UploadThrottle(None, 1).acquire(600))
+            self.assertIsNone(throttling.UploadThrottle(None, 1).acquire(400))
+            self.assertEqual(
+                throttling.UploadThrottle(None, 1).acquire(100), 8)
+            # Refused chunks don't use up the window
+            self.assertEqual(
+                throttling.UploadThrottle(None, 1).acquire(100), 8)
+            self.assertEqual(cache.get(throttling.RATE_KEY % (
+                "user", 1, 100)), 1000)
+        with mock.patch.object(throttling.time, "time", return_value=1010):
+            self.assertIsNone(throttling.UploadThrottle(None, 1).acquire(100))
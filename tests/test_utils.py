@@ -0,0 +1,92 @@
+import io
+import os
+import gzip
+import zlib
+import errno
+import tempfile
+from unittest import mock
+
+from django.test import SimpleTestCase
+
+from .. import utils
+
+
+class UtilsTestCase(SimpleTestCase):
+
+    def test_calc_checksum(self):
+        self.assertEqual(
+            utils.calc_checksum("md5", b"mydata"),
+            "69380a4489890f8a53e0eddc36cd1379")
+        self.assertIsNone(utils.calc_checksum("unknown", b"mydata"))
+
+    def test_missing_ranges(self):
+        self.assertEqual(utils.missing_ranges([], 100), [[0, 100]])
+        self.assertEqual(
+            utils.missing_ranges([(0, 10), (10, 90)], 100), [])
+        self.assertEqual(
+            utils.missing_ranges([(10, 10), (50, 10)], 100),
+            [[0, 10], [20, 50], [60, 100]])
+        self.assertEqual(
+            utils.missing_ranges([(0, 60), (50, 60)], 100), [])
+
+    def test_calc_checksums(self):
+        data = b"mydata" * 200000
+        checksums = utils.calc_checksums(["md5", "sha256", "crc32"], data)
+        for algorithm, checksum in checksums.items():
+            self.assertEqual(
+                checksum, utils.calc_checksum(algorithm, data))
+        self.assertEqual(
+            utils.calc_checksum("crc32", b"mydata"),
+            "%08x" % zlib.crc32(b"mydata"))
+        with self.assertRaises(ValueError):
+            utils.MultiHasher(["unknown"])
+
+    def test_decompressing_reader(self):
+        data = b"mydata" * 200000
+        for encoding, compressed in [
+                ("gzip", gzip.compress(data)),
+                ("deflate", zlib.compress(data))]:
+            reader = utils.DecompressingReader(
+                io.BytesIO(compressed), encoding, 100)
+            output = bytearray()
+            self.assertEqual(
+                utils.copy_stream(
+                    reader, output.extend, len(data), None, 1000),
+                len(data))
+            self.assertEqual(bytes(output), data)
+        # Reading stops past the limit, whatever the compression ratio
+        reader = utils.DecompressingReader(
+            io.BytesIO(zlib.compress(data)), "deflate")
+        self.assertEqual(
+            utils.copy_stream(reader, lambda block: None, 1000, None, 300),
+            1001)
+
+    def test_calc_file_checksums(self):
+        data = b"mydata" * 200000
+        with io.BytesIO(data) as file:
+            self.assertEqual(
+                utils.calc_file_checksums(["md5", "sha512"], file, 1000),
+                utils.calc_checksums(["md5", "sha512"], data))
+            self.assertEqual(file.tell(), 0)
+
+    def test_move_file_across_devices(self):
+        folder = tempfile.mkdtemp()
+        src_path = os.path.join(folder, "src")
+        dst_path = os.path.join(folder, "dst")
+        with open(src_path, "wb") as f:
+            f.write(b"mydata")
+        replace = os.replace
+
+        def cross_device(src, dst):
+            if src == src_path:
+                raise OSError(errno.EXDEV, "Invalid cross-device link")
+            replace(src, dst)
+
+        with mock.patch.object(utils.os, "replace", cross_device):
+            utils.move_file(src_path, dst_path)
+        self.assertFalse(os.path.exists(src_path))
+        self.assertEqual(os.listdir(folder), ["dst"])
+        with open(dst_path, "rb") as f:
+            self.assertEqual(f.read(), b"mydata")
+        os.remove(dst_path)
+        os.rmdir(folder)
@@ -0,0 +1,105 @@
+import math
+import time
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+logger = logging.getLogger(__name__)
+
+# Chunks being received, per instrument or user
+ACTIVE_KEY = "mydata_upload_active_%s_%s"
+
+# Bytes accepted within rate window, per instrument or user
+RATE_KEY = "mydata_upload_rate_%s_%s_%s"
+
+
+def incr(key, delta, timeout):
+    """
+    Increment counter shared between processes through the cache,
+    keeping it for timeout seconds since the last increment, so counters
+    in continuous use don't expire while their slots are taken
+    """
+    if not cache.add(key, delta, timeout):
+        try:
+            value = cache.incr(key, delta)
+        except ValueError:
+            # Expired in between
+            cache.add(key, delta, timeout)
+            return delta
+        cache.touch(key, timeout)
+        return value
+    return delta
+
+
+class UploadThrottle:
+    """
+    Limits of concurrent chunks and bytes per second of an upload,
+    for the instrument and the user sending it.
+    Counters are kept in Django cache, which must be shared between
+    processes (memcached, redis) for the limits to apply site-wide.
+    """
+
+    def __init__(self, instrument_id, user_id):
+        self.limits = []
+        for kind, key_id in [("instrument", instrument_id),
+                             ("user", user_id)]:
+            if key_id is None:
+                continue
+            name = kind.upper()
+            concurrency = getattr(
+                settings, "CHUNK_MAX_CONCURRENT_PER_%s" % name, 0)
+            rate = getattr(settings, "CHUNK_MAX_RATE_PER_%s" % name, 0)
+            if concurrency or rate:
+                self.limits.append((kind, key_id, concurrency, rate))
+        self.acquired = []
+
+    def acquire(self, length):
+        """
+        Take a slot for a chunk of length bytes,
+        returns seconds to wait before retry if a limit is reached.
+        Bytes are only counted against rate limits if the chunk is let in.
+        """
+        timeout = getattr(settings, "CHUNK_THROTTLE_TIMEOUT", 3600)
+        window = getattr(settings, "CHUNK_RATE_WINDOW", 10)
+        now = time.time()
+        charged = []
+        retry_after = None
+        for kind, key_id, concurrency, rate in self.limits:
+            if concurrency:
+                key = ACTIVE_KEY % (kind, key_id)
+                self.acquired.append(key)
+                if incr(key, 1, timeout) > concurrency:
+                    retry_after = getattr(settings, "CHUNK_RETRY_AFTER", 60)
+                    break
+            if rate:
+                period = int(now // window)
+                key = RATE_KEY % (kind, key_id, period)
+                charged.append(key)
+                used = incr(key, length, window * 2)
+                if used > rate * window and used != length:
+                    # Single chunk larger than window allowance
+                    # is let through on an idle window
+                    retry_after = max(
+                        1, math.ceil((period + 1) * window - now))
+                    break
+        if retry_after is not None:
+            for key in charged:
+                try:
+                    cache.decr(key, length)
+                except ValueError:
+                    pass
+            self.release()
+        return retry_after
+
+    def release(self):
+        """
+        Free concurrency slots taken by acquire
+        """
+        for key in self.acquired:
+            try:
+                cache.decr(key)
+            except ValueError:
+                logger.warning("Upload counter %s expired" % key)
+        self.acquired = []
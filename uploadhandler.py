@@ -0,0 +1,41 @@
+from django.core.files.uploadhandler import FileUploadHandler
+
+from . import utils
+
+
+class ChecksumUploadHandler(FileUploadHandler):
+    """
+    Calculate checksums of uploaded files while Django parses them,
+    passing data on to the next upload handler unchanged.
+    Files are hashed as they are received only if the handler is
+    installed before the request body is read, otherwise they are
+    hashed while the buffered body is parsed.
+    Checksums are kept in checksums dict by form field name.
+    """
+
+    def __init__(self, request=None, algorithms=()):
+        super().__init__(request)
+        self.algorithms = list(algorithms)
+        self.checksums = {}
+        self.hasher = None
+        self.buffer = bytearray()
+
+    def new_file(self, field_name, *args, **kwargs):
+        super().new_file(field_name, *args, **kwargs)
+        self.hasher = utils.MultiHasher(self.algorithms)
+        self.buffer = bytearray()
+
+    def receive_data_chunk(self, raw_data, start):
+        # Collect blocks large enough to be hashed in parallel
+        self.buffer += raw_data
+        if len(self.buffer) >= utils.PARALLEL_HASH_SIZE:
+            self.hasher.update(bytes(self.buffer))
+            self.buffer = bytearray()
+        return raw_data
+
+    def file_complete(self, file_size):
+        self.hasher.update(bytes(self.buffer))
+        self.buffer = bytearray()
+        # Only the first file of a field is used
+        self.checksums.setdefault(self.field_name, self.hasher.hexdigests())
+        return None
@@ -1,17 +1,392 @@
+import os
+import sys
+import errno
+import shutil
+import tempfile
 import hashlib
+import zlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import xxhash
 
+try:
+    import crc32c
+except ImportError:
+    crc32c = None
+
+
+# Errors meaning that kernel-side copy is not supported for given files
+COPY_FALLBACK_ERRORS = (
+    errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP)
+
+
+class Crc32Hasher:
+    """
+    Incremental CRC-32 with hashlib-like interface
+    """
+
+    def __init__(self, function=zlib.crc32):
+        self.function = function
+        self.value = 0
+
+    def update(self, data):
+        self.value = self.function(data, self.value)
+
+    def hexdigest(self):
+        return "%08x" % (self.value & 0xffffffff)
+
+
+# Factories of incremental hashers by checksum algorithm name
+CHECKSUM_ALGORITHMS = {
+    "xxh3_64": xxhash.xxh3_64,
+    "xxh128": xxhash.xxh3_128,
+    "md5": hashlib.md5,
+    "sha256": hashlib.sha256,
+    "sha512": hashlib.sha512,
+    "crc32": Crc32Hasher
+}
+if crc32c is not None:
+    CHECKSUM_ALGORITHMS["crc32c"] = lambda: Crc32Hasher(crc32c.crc32c)
+
+# Buffers of this size and above are hashed in parallel threads
+PARALLEL_HASH_SIZE = 1000000
+
+
+def get_hasher(algorithm):
+    """
+    Create incremental hasher for the checksum algorithm
+    """
+
+    factory = CHECKSUM_ALGORITHMS.get(algorithm)
+    if factory is None:
+        return None
+
+    return factory()
+
 
 def calc_checksum(algorithm, data):
     """
     Calculate checksum for a binary data
     """
 
-    if algorithm == "xxh3_64":
-        checksum = xxhash.xxh3_64(data).hexdigest()
-    elif algorithm == "md5":
-        checksum = hashlib.md5(data).hexdigest()
+    hasher = get_hasher(algorithm)
+    if hasher is None:
+        return None
+    hasher.update(data)
+
+    return hasher.hexdigest()
+
+
+class MultiHasher:
+    """
+    Calculate checksums for several algorithms in a single pass over data,
+    large blocks are passed to hashers in parallel threads
+    (hashlib and xxhash release the GIL)
+    """
+
+    pool = None
+    pool_lock = threading.Lock()
+
+    def __init__(self, algorithms):
+        self.hashers = {}
+        for algorithm in algorithms:
+            hasher = get_hasher(algorithm)
+            if hasher is None:
+                raise ValueError("Unsupported algorithm %s" % algorithm)
+            self.hashers[algorithm] = hasher
+
+    @classmethod
+    def get_pool(cls):
+        # Requests hashing in parallel threads must share one pool
+        with cls.pool_lock:
+            if cls.pool is None:
+                cls.pool = ThreadPoolExecutor(
+                    max_workers=len(CHECKSUM_ALGORITHMS),
+                    thread_name_prefix="mydata-checksum")
+        return cls.pool
+
+    def update(self, data):
+        if len(self.hashers) > 1 and len(data) >= PARALLEL_HASH_SIZE:
+            futures = [
+                self.get_pool().submit(hasher.update, data)
+                for hasher in self.hashers.values()
+            ]
+            for future in futures:
+                future.result()
+        else:
+            for hasher in self.hashers.values():
+                hasher.update(data)
+
+    def hexdigests(self):
+        return {
+            algorithm: hasher.hexdigest()
+            for algorithm, hasher in self.hashers.items()
+        }
+
+
+def calc_checksums(algorithms, data):
+    """
+    Calculate checksums of several algorithms for a binary data
+    """
+
+    hasher = MultiHasher(algorithms)
+    hasher.update(data)
+
+    return hasher.hexdigests()
+
+
+def calc_file_checksums(algorithms, file, block_size=PARALLEL_HASH_SIZE):
+    """
+    Calculate checksums of several algorithms in one read of a file,
+    leaving file at its start
+    """
+
+    hasher = MultiHasher(algorithms)
+    file.seek(0)
+    while True:
+        data = file.read(block_size)
+        if not data:
+            break
+        hasher.update(data)
+    file.seek(0)
+
+    return hasher.hexdigests()
+
+
+def hash_files(hasher, paths, block_size=PARALLEL_HASH_SIZE):
+    """
+    Pass contents of the files to hasher, one file after another
+    """
+
+    for path in paths:
+        with open(path, "rb") as file:
+            while True:
+                data = file.read(block_size)
+                if not data:
+                    break
+                hasher.update(data)
+
+    return hasher
+
+
+def move_file(src_path, dst_path):
+    """
+    Move file, which might be on another device, replacing dst_path
+    atomically: data is copied to a temporary file next to dst_path first,
+    so dst_path is never seen partially written
+    """
+
+    try:
+        os.replace(src_path, dst_path)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+
+    fd, tmp_path = tempfile.mkstemp(
+        prefix=".tmp-", dir=os.path.dirname(dst_path))
+    try:
+        with open(src_path, "rb") as src, os.fdopen(fd, "wb") as dst:
+            shutil.copyfileobj(src, dst, PARALLEL_HASH_SIZE)
+        os.replace(tmp_path, dst_path)
+    except Exception:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    os.remove(src_path)
+
+
+def copy_stream(src, write, limit, hasher=None, block_size=1000000):
+    """
+    Copy data from a file-like object in blocks of block_size bytes,
+    updating hasher and passing every block to write.
+    Stops once more than limit bytes were read, so memory use is bounded
+    by block_size and the caller can reject oversized bodies.
+    Returns total number of bytes read.
+    """
+
+    total = 0
+    while True:
+        data = src.read(min(block_size, limit - total + 1))
+        if not data:
+            break
+        total += len(data)
+        if total > limit:
+            break
+        if hasher is not None:
+            hasher.update(data)
+        write(data)
+
+    return total
+
+
+# zlib window bits for supported Content-Encoding of chunk bodies,
+# deflate is accepted with zlib header as in HTTP or gzip header
+CONTENT_ENCODINGS = {
+    "gzip": 16 + zlib.MAX_WBITS,
+    "deflate": 32 + zlib.MAX_WBITS
+}
+
+
+class DecompressingReader:
+    """
+    File-like reader returning decompressed data of a compressed stream.
+    Never inflates more than requested from read(), so memory use is
+    bounded by the read size whatever the compression ratio.
+    """
+
+    def __init__(self, src, encoding, block_size=1000000):
+        self.src = src
+        self.block_size = block_size
+        self.decompressor = zlib.decompressobj(CONTENT_ENCODINGS[encoding])
+
+    def read(self, size):
+        decompressor = self.decompressor
+        while True:
+            if decompressor.unconsumed_tail:
+                data = decompressor.unconsumed_tail
+            elif decompressor.eof:
+                return b""
+            else:
+                data = self.src.read(self.block_size)
+                if not data:
+                    # Truncated stream
+                    return decompressor.flush()
+            data = decompressor.decompress(data, size)
+            if data:
+                return data
+
+
+class OffsetWriter:
+    """
+    File-like writer which puts data at consecutive positions of an open
+    file descriptor, starting from offset, without moving the file pointer
+    """
+
+    def __init__(self, fd, offset):
+        self.fd = fd
+        self.offset = offset
+
+    def write(self, data):
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(self.fd, view, self.offset)
+            view = view[written:]
+            self.offset += written
+
+
+def preallocate_file(path, size, method="sparse"):
+    """
+    Open (create if needed) a file for positional writes and extend it
+    to size bytes, either sparse or with fallocate.
+    Returns an open file descriptor.
+    """
+
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o660)
+    try:
+        if os.fstat(fd).st_size < size:
+            if method == "fallocate" and hasattr(os, "posix_fallocate"):
+                os.posix_fallocate(fd, 0, size)
+            else:
+                os.ftruncate(fd, size)
+    except Exception:
+        os.close(fd)
+        raise
+
+    return fd
+
+
+def copy_file_at(src_fd, dst_fd, offset, count, block_size=10000000):
+    """
+    Copy count bytes from the start of src_fd into dst_fd at offset.
+    Uses copy_file_range or sendfile to keep data in the kernel and falls
+    back to reading into a single reusable buffer.
+    Returns total number of bytes copied.
+    """
+
+    copied = 0
+
+    if hasattr(os, "copy_file_range"):
+        try:
+            while copied < count:
+                size = os.copy_file_range(
+                    src_fd, dst_fd, count - copied, copied, offset + copied)
+                if size == 0:
+                    return copied
+                copied += size
+            return copied
+        except OSError as e:
+            if e.errno not in COPY_FALLBACK_ERRORS:
+                raise
+
+    if hasattr(os, "sendfile") and sys.platform.startswith("linux"):
+        try:
+            os.lseek(dst_fd, offset + copied, os.SEEK_SET)
+            while copied < count:
+                size = os.sendfile(dst_fd, src_fd, copied, count - copied)
+                if size == 0:
+                    return copied
+                copied += size
+            return copied
+        except OSError as e:
+            if e.errno not in COPY_FALLBACK_ERRORS:
+                raise
+
+    buffer = memoryview(bytearray(max(min(block_size, count - copied), 1)))
+    writer = OffsetWriter(dst_fd, offset + copied)
+    os.lseek(src_fd, copied, os.SEEK_SET)
+    while copied < count:
+        size = os.readv(src_fd, [buffer[:min(len(buffer), count - copied)]])
+        if size == 0:
+            break
+        writer.write(buffer[:size])
+        copied += size
+
+    return copied
+
+
+def assemble_file(dst_path, parts, threads=1, block_size=10000000):
+    """
+    Copy parts, given as (path, offset, size), into existing file dst_path.
+    Every part is copied using its own file descriptors, so up to threads
+    parts can be copied in parallel.
+    """
+
+    def copy_part(part):
+        file_path, offset, size = part
+        with open(file_path, "rb") as src, open(dst_path, "rb+") as dst:
+            copied = copy_file_at(
+                src.fileno(), dst.fileno(), offset, size, block_size)
+        if copied != size:
+            raise IOError("Incomplete chunk file %s" % file_path)
+
+    if threads > 1 and len(parts) > 1:
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            list(pool.map(copy_part, parts))
     else:
-        checksum = None
+        for part in parts:
+            copy_part(part)
+
+
+def missing_ranges(chunks, size):
+    """
+    Find byte ranges of a file of size bytes not covered by chunks,
+    given as (offset, size) pairs ordered by offset.
+    Returns list of [start, end) ranges.
+    """
+
+    missing = []
+    offset = 0
+    for chunk_offset, chunk_size in chunks:
+        if chunk_offset > offset:
+            missing.append([offset, min(chunk_offset, size)])
+        offset = max(offset, chunk_offset + chunk_size)
+        if offset >= size:
+            break
+    if offset < size:
+        missing.append([offset, size])
 
-    return checksum
+    return missing